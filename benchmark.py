@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import threading
+from io import BytesIO
+from pathlib import Path
+from datetime import datetime, timezone
+
+# The stand-in accepts any credentials; fixed ones make sure nothing real is used
+os.environ.update({
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+})
+# Text extraction and thumbnails measure pypdf and pdfium rather than S3;
+# --extract turns extraction back on, THUMBNAILS=1 the thumbnails
+os.environ.setdefault("EXTRACT_TEXT", "0")
+os.environ.setdefault("THUMBNAILS", "0")
+
+import boto3
+
+# moto is only needed here, as the in-process S3 stand-in (pip install moto).
+# It is imported before the app so every S3 client the app makes goes to it.
+try:
+    from moto import mock_aws
+    from moto.core import DEFAULT_ACCOUNT_ID
+    from moto.s3.models import s3_backends
+except ImportError:
+    mock_aws = None
+
+# Keep Streamlit quiet about running outside "streamlit run"
+import streamlit as st
+import streamlit.logger
+streamlit.logger.set_log_level("error")
+from streamlit.testing.v1 import AppTest
+
+from streamlit_app import (
+    BUCKET_NAME,
+    DEPARTMENTS,
+    KEY_LAYOUT,
+    MANIFEST_ENABLED,
+    MANIFEST_KEY,
+    MANIFEST_VERSION,
+    PREDEFINED_TAGS,
+    SEMESTERS,
+    generate_metadata_csv,
+    metadata_key,
+    metadata_record,
+    new_document_key,
+    percentile,
+    stable_document_id,
+)
+
+APP_FILE = str(Path(__file__).with_name("streamlit_app.py"))
+
+# S3 operations reported together, so results stay comparable when the app
+# switches e.g. from GetObject to HeadObject for a check
+OPERATION_GROUPS = {
+    "LIST": ("ListObjectsV2", "ListMultipartUploads", "ListParts"),
+    "GET": ("GetObject", "HeadObject"),
+    "PUT": ("PutObject", "CopyObject", "CreateMultipartUpload", "UploadPart", "CompleteMultipartUpload"),
+    "DELETE": ("DeleteObjects", "DeleteObject", "AbortMultipartUpload"),
+}
+GROUP_OF = {operation: group for group, operations in OPERATION_GROUPS.items() for operation in operations}
+
+# A flow slower than its baseline by more than this fraction is a regression
+DEFAULT_THRESHOLD = 0.2
+
+# Flows slower than this in milliseconds are never flagged; timer noise
+# dominates below it
+NOISE_FLOOR_MS = 5.0
+
+# Name prefix typed into the edit page's filter; it matches the first 100
+# documents of every catalog
+FILTER_PREFIX = "doc-0000"
+
+# Calls per timing of generate_metadata_csv
+CSV_CALLS = 10000
+
+# S3 requests made during the flow being measured, filled from botocore events
+# on every client's thread, and the latency injected per operation group
+recorder = {"lock": threading.Lock(), "requests": {}, "latency": {}}
+
+# Function to register the latency and timing hooks on the default session,
+# which every client the app creates is built from. The latency hook runs
+# before the stand-in answers, so it is part of what the app sees.
+def instrument_session():
+    boto3.setup_default_session()
+    events = boto3.DEFAULT_SESSION.events
+
+    def inject_latency(event_name, **kwargs):
+        operation = event_name.rsplit(".", 1)[-1]
+        delay = recorder["latency"].get(GROUP_OF.get(operation, "OTHER"), 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def before_call(model, context, **kwargs):
+        context["benchmark_start"] = time.perf_counter()
+
+    def after_call(model, context, **kwargs):
+        start = context.pop("benchmark_start", None)
+        if start is not None:
+            with recorder["lock"]:
+                recorder["requests"].setdefault(model.name, []).append(time.perf_counter() - start)
+
+    events.register_first("before-send.s3", inject_latency)
+    events.register("before-call.s3", before_call)
+    events.register("after-call.s3", after_call)
+    events.register("after-call-error.s3", after_call)
+
+# Function to build a catalog of count documents straight in the stand-in,
+# without requests or injected latency. Names, metadata and keys are the same
+# on every run, so results from different commits describe the same catalog.
+def seed_catalog(count, manifest):
+    rng = random.Random(count)
+    backend = s3_backends[DEFAULT_ACCOUNT_ID]["aws"]
+    backend.create_bucket(BUCKET_NAME, os.environ["AWS_REGION"])
+    pdf = b"%PDF-1.4\n% benchmark document\n%%EOF\n"
+    records = {}
+    for i in range(count):
+        record = metadata_record(
+            f"doc-{i:06d}",
+            rng.sample(DEPARTMENTS, rng.randint(1, 2)),
+            rng.sample(SEMESTERS, rng.randint(1, 3)),
+            rng.sample(PREDEFINED_TAGS, rng.randint(0, 2))
+        )
+        pdf_key = new_document_key(
+            record["file_name"], record["departments"], doc_id=stable_document_id(f"benchmark/{i}")
+        )
+        backend.put_object(BUCKET_NAME, pdf_key, pdf)
+        csv_body = generate_metadata_csv(
+            record["file_name"], record["departments"], record["semesters"], record["tags"]
+        )
+        backend.put_object(BUCKET_NAME, metadata_key(pdf_key), csv_body.encode("utf-8"))
+        records[pdf_key] = record
+
+    if manifest:
+        lines = [json.dumps({"version": MANIFEST_VERSION, "revision": 1}, separators=(",", ":"))]
+        for key in sorted(records):
+            lines.append(json.dumps({"key": key, **records[key]}, separators=(",", ":")))
+        backend.put_object(BUCKET_NAME, MANIFEST_KEY, ("\n".join(lines) + "\n").encode("utf-8"))
+    return records
+
+# Function to summarise request timings by operation group
+def summarise_requests(requests):
+    groups = {}
+    for operation, samples in requests.items():
+        groups.setdefault(GROUP_OF.get(operation, "OTHER"), []).extend(samples)
+    return {
+        group: {
+            "count": len(samples),
+            "p50_ms": round(percentile(samples, 50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            "total_ms": round(sum(samples) * 1000, 2),
+        }
+        for group, samples in sorted(groups.items())
+    }
+
+# Function to time one step of a flow. The step gets the AppTest and returns
+# it after running; its wall time is the time the page took to render.
+def measure(name, at, step):
+    with recorder["lock"]:
+        recorder["requests"] = {}
+    start = time.perf_counter()
+    at = step(at)
+    render = time.perf_counter() - start
+    with recorder["lock"]:
+        requests = recorder["requests"]
+        recorder["requests"] = {}
+
+    problems = [element.value for element in at.error]
+    problems += [element.message for element in at.exception]
+    return at, {
+        "flow": name,
+        "render_ms": round(render * 1000, 2),
+        "requests": summarise_requests(requests),
+        "operations": {operation: len(samples) for operation, samples in sorted(requests.items())},
+        "errors": [str(problem) for problem in problems],
+    }
+
+# Function to find a button by its label
+def button(at, label):
+    return next(element for element in at.button if element.label == label)
+
+# Function to make in-memory files for the upload page, staged the way the
+# file uploader leaves them
+def staged_files(count, size):
+    rng = random.Random(size)
+    entries = []
+    for i in range(count):
+        body = b"%PDF-1.4\n" + rng.randbytes(size) + b"\n%%EOF\n"
+        entries.append({
+            "file_id": f"benchmark-{i}",
+            "name": f"upload-{i:04d}.pdf",
+            "size": len(body),
+            "file": BytesIO(body),
+            "path": None,
+            "doc_id": stable_document_id(f"benchmark/upload/{i}"),
+        })
+    return entries
+
+# Function to run every flow against a fresh catalog of the given size
+def run_size(count, args):
+    flows = []
+    with mock_aws():
+        # Clients, indexes and caches from the previous size must not be reused
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        instrument_session()
+
+        start = time.perf_counter()
+        records = seed_catalog(count, MANIFEST_ENABLED)
+        print(f"  seeded {count} documents in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+        def record(name, at, step):
+            at, result = measure(name, at, step)
+            flows.append(result)
+            for error in result["errors"]:
+                print(f"  {name}: {error}", file=sys.stderr)
+            return at
+
+        at = AppTest.from_file(APP_FILE, default_timeout=args.timeout)
+        at = record("home", at, lambda at: at.run())
+
+        at.session_state["page"] = "Edit Existing Files"
+        at = record("edit_cold", at, lambda at: at.run())
+        at = record("edit_rerun", at, lambda at: at.run())
+        at = record("filter_prefix", at, lambda at: at.text_input(key="filter_prefix").input(FILTER_PREFIX).run())
+        at = record("filter_clear", at, lambda at: at.text_input(key="filter_prefix").input("").run())
+        at = record("filter_facets", at, lambda at: at.multiselect(key="filter_dept").select(DEPARTMENTS[0]).run())
+        selected = next(key for key, document in records.items() if DEPARTMENTS[0] in document["departments"])
+        at = record("select_document", at, lambda at: at.selectbox(key="edit_selection").select(selected).run())
+        at.multiselect(key="edit_tags").set_value([PREDEFINED_TAGS[-1]])
+        at = record("save_metadata", at, lambda at: button(at, "Save Changes").click().run())
+
+        at.session_state["page"] = "Upload Files"
+        at.session_state["staged_uploads"] = staged_files(args.upload_files, args.upload_kb * 1024)
+        at = record("upload_grid", at, lambda at: at.run())
+        at = record("upload_batch", at, lambda at: button(at, "Upload All Files").click().run())
+
+    # Pure CPU work, timed per call
+    start = time.perf_counter()
+    for _ in range(CSV_CALLS):
+        generate_metadata_csv("Lecture Notes", ["All"], ["S1", "S2"], PREDEFINED_TAGS[:3])
+    flows.append({
+        "flow": "generate_metadata_csv",
+        "render_ms": round((time.perf_counter() - start) / CSV_CALLS * 1000, 4),
+        "requests": {},
+        "operations": {},
+        "errors": [],
+    })
+    return flows
+
+# Function to describe the commit being measured
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Function to parse latencies given as GROUP=milliseconds, e.g. LIST=40,PUT=25
+def parse_latency(base_ms, overrides):
+    latency = {group: base_ms / 1000 for group in (*OPERATION_GROUPS, "OTHER")}
+    for item in filter(None, (overrides or "").split(",")):
+        group, _, value = item.partition("=")
+        group = group.strip().upper()
+        if group not in latency:
+            raise ValueError(f"unknown operation group {group!r}; use {', '.join(latency)}")
+        latency[group] = float(value) / 1000
+    return latency
+
+# Function to print the results as a table, one line per size and flow
+def print_table(report):
+    print(f"{'size':>7}  {'flow':<22}{'render ms':>11}" + "".join(f"{group + ' n/p50':>16}" for group in ("LIST", "GET", "PUT")))
+    for result in report["results"]:
+        for flow in result["flows"]:
+            cells = ""
+            for group in ("LIST", "GET", "PUT"):
+                stats = flow["requests"].get(group)
+                cells += f"{stats['count']:>8}/{stats['p50_ms']:<7}" if stats else f"{'-':>16}"
+            print(f"{result['size']:>7}  {flow['flow']:<22}{flow['render_ms']:>11}{cells}")
+
+# Function to compare render times and request counts with an earlier report.
+# Returns the regressions as (size, flow, what, before, after).
+def compare(report, baseline, threshold):
+    before = {
+        (result["size"], flow["flow"]): flow
+        for result in baseline["results"] for flow in result["flows"]
+    }
+    regressions = []
+    for result in report["results"]:
+        for flow in result["flows"]:
+            old = before.get((result["size"], flow["flow"]))
+            if old is None:
+                continue
+            if (flow["render_ms"] > NOISE_FLOOR_MS
+                    and flow["render_ms"] > old["render_ms"] * (1 + threshold)):
+                regressions.append((result["size"], flow["flow"], "render ms", old["render_ms"], flow["render_ms"]))
+            for group, stats in flow["requests"].items():
+                old_count = old["requests"].get(group, {}).get("count", 0)
+                if stats["count"] > old_count:
+                    regressions.append((result["size"], flow["flow"], f"{group} requests", old_count, stats["count"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the app's pages against an in-process S3 stand-in with injected latency, "
+                    "for catalogs of several sizes, and write the results as JSON for comparison across commits."
+    )
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="catalog sizes, comma-separated")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="latency added to every S3 request")
+    parser.add_argument(
+        "--latency",
+        help="latency per operation group in ms, overriding --latency-ms, e.g. LIST=40,GET=10,PUT=25"
+    )
+    parser.add_argument("--upload-files", type=int, default=20, help="files uploaded by the upload flow")
+    parser.add_argument("--upload-kb", type=int, default=256, help="size of each uploaded file in KB")
+    parser.add_argument("--timeout", type=float, default=3600, help="longest a single page run may take, in seconds")
+    parser.add_argument("--output", help="JSON file for the results (default: benchmark-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results to compare with; regressions make the exit status 1")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="fraction by which a render may be slower than in --compare before it counts as a regression"
+    )
+    parser.add_argument("--extract", action="store_true", help="extract text from uploaded files, as the app does by default")
+    args = parser.parse_args(argv)
+
+    if mock_aws is None:
+        parser.error("the S3 stand-in needs moto; install it with pip install moto")
+    if args.extract:
+        os.environ["EXTRACT_TEXT"] = "1"
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        recorder["latency"] = parse_latency(args.latency_ms, args.latency)
+    except ValueError as e:
+        parser.error(str(e))
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "settings": {
+            "sizes": sizes,
+            "latency_ms": {group: seconds * 1000 for group, seconds in recorder["latency"].items()},
+            "key_layout": KEY_LAYOUT,
+            "manifest": MANIFEST_ENABLED,
+            "upload_files": args.upload_files,
+            "upload_kb": args.upload_kb,
+            "extract": args.extract,
+        },
+        "results": [],
+    }
+    for size in sizes:
+        print(f"Catalog of {size} documents:", file=sys.stderr)
+        report["results"].append({"size": size, "flows": run_size(size, args)})
+
+    output = args.output or f"benchmark-{commit}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print_table(report)
+    print(f"Results written to {output}.")
+
+    failed = any(flow["errors"] for result in report["results"] for flow in result["flows"])
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("settings", {}).get("latency_ms") != report["settings"]["latency_ms"]:
+            print("Warning: the baseline was measured with different latencies.", file=sys.stderr)
+        regressions = compare(report, baseline, args.threshold)
+        print(f"{len(regressions)} regression(s) compared with {baseline.get('commit', args.compare)}.")
+        for size, flow, what, old, new in regressions:
+            print(f"  {size} documents, {flow}: {what} {old} -> {new}")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+import os
+import csv
+import sys
+import json
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+
+# Keep Streamlit quiet about running outside "streamlit run"
+import streamlit.logger
+streamlit.logger.set_log_level("error")
+
+from streamlit_app import (
+    BUCKET_NAME,
+    DOCUMENTS_PREFIX,
+    DEPARTMENTS,
+    EXTRACTION_AVAILABLE,
+    EXTRACTION_ENABLED,
+    MANIFEST_ENABLED,
+    PREDEFINED_TAGS,
+    SEMESTERS,
+    THUMBNAILS_ENABLED,
+    UPLOAD_WORKERS,
+    append_changes,
+    change_record,
+    check_document_name,
+    count_changes,
+    document_sizes,
+    get_metadata,
+    is_flat_key,
+    list_pdf_keys,
+    metadata_record,
+    new_document_key,
+    read_hash_index,
+    record_content_hashes,
+    run_throttled,
+    sha256_of,
+    stable_document_id,
+    update_catalog_stats,
+    update_hash_index,
+    update_manifest,
+    upload_document,
+)
+
+# Fields that can appear in a --layout, and the values each one accepts
+LAYOUT_FIELDS = {
+    "department": DEPARTMENTS,
+    "semester": SEMESTERS,
+    "tag": PREDEFINED_TAGS,
+}
+
+# How many finished uploads are collected before the manifest, hash index and
+# change feed are updated, so an interrupted run loses at most this many entries
+INDEX_FLUSH_EVERY = 100
+
+# Function to read a mapping CSV with the columns path, file_name, departments,
+# semesters and tags (lists comma-separated, as in the metadata CSVs). Paths
+# are relative to the source directory.
+def load_mapping(mapping_file):
+    mapping = {}
+    with open(mapping_file, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            mapping[Path(row["path"]).as_posix()] = metadata_record(
+                row.get("file_name") or Path(row["path"]).stem,
+                [d for d in row.get("departments", "").split(",") if d],
+                [s for s in row.get("semesters", "").split(",") if s],
+                [t for t in row.get("tags", "").split(",") if t]
+            )
+    return mapping
+
+# Function to take metadata from the directories a file sits in. With the
+# layout "department/semester", Physics/S1/notes.pdf gets the department
+# "Physics" and the semester "S1". "All" is accepted for departments and
+# semesters.
+def metadata_from_path(relative_path, layout):
+    folders = relative_path.parts[:-1]
+    if len(folders) < len(layout):
+        raise ValueError(f"expected {len(layout)} folder level(s) ({'/'.join(layout)})")
+
+    values = {"department": [], "semester": [], "tag": []}
+    for field, folder in zip(layout, folders):
+        allowed = LAYOUT_FIELDS[field]
+        if folder not in allowed and not (folder == "All" and field != "tag"):
+            raise ValueError(f"unknown {field} {folder!r}")
+        values[field].append(folder)
+    return metadata_record(relative_path.stem, values["department"], values["semester"], values["tag"])
+
+# Function to load the files finished by earlier runs. Each line of the
+# checkpoint records a source path with the size and modification time it had
+# when it was uploaded, so files changed since then are uploaded again.
+# Returns those entries and the keys earlier runs uploaded to.
+def load_checkpoint(checkpoint_file):
+    done = set()
+    keys = set()
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Partly written line from an interrupted run
+                done.add((entry["path"], entry["size"], entry["mtime"]))
+                keys.add(entry.get("key"))
+    return done, keys
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Upload a directory tree of PDFs and their metadata to S3 without the web app."
+    )
+    parser.add_argument("source", help="directory to search for PDFs (recursively)")
+    parser.add_argument("--mapping", help="CSV with path,file_name,departments,semesters,tags for each PDF")
+    parser.add_argument(
+        "--layout",
+        help="metadata taken from folder names, e.g. department/semester or department/semester/tag"
+    )
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="files uploaded in parallel")
+    parser.add_argument(
+        "--checkpoint",
+        default=".ingest_checkpoint.jsonl",
+        help="file recording finished uploads, so an interrupted run can be resumed"
+    )
+    parser.add_argument("--upload-duplicates", action="store_true", help="upload files even if their content is already stored")
+    parser.add_argument(
+        "--replace-existing",
+        action="store_true",
+        help="let files replace documents of the same name that were not uploaded by this tool"
+    )
+    parser.add_argument("--no-extract", action="store_true", help="do not store the extracted text next to each PDF")
+    parser.add_argument("--no-thumbnails", action="store_true", help="do not draw first-page thumbnails while uploading")
+    parser.add_argument("--dry-run", action="store_true", help="only show what would be uploaded")
+    args = parser.parse_args(argv)
+
+    if not args.mapping and not args.layout:
+        parser.error("give --mapping, --layout or both")
+    layout = args.layout.split("/") if args.layout else []
+    for field in layout:
+        if field not in LAYOUT_FIELDS:
+            parser.error(f"unknown layout field {field!r}; use {', '.join(LAYOUT_FIELDS)}")
+
+    if not args.no_extract and not EXTRACTION_AVAILABLE:
+        print("pypdf is not installed, so no text will be extracted.", file=sys.stderr)
+    extract = EXTRACTION_ENABLED and not args.no_extract
+    thumbnails = THUMBNAILS_ENABLED and not args.no_thumbnails
+
+    source = Path(args.source)
+    mapping = load_mapping(args.mapping) if args.mapping else {}
+    done, uploaded_keys = load_checkpoint(args.checkpoint)
+
+    # Work out the metadata and key of every file before uploading anything
+    jobs = []
+    failures = []
+    keys = {}
+    skipped = 0
+    for path in sorted(source.rglob("*")):
+        if not path.is_file() or path.suffix.lower() != ".pdf":
+            continue
+        relative_path = path.relative_to(source)
+        stat = path.stat()
+        if (relative_path.as_posix(), stat.st_size, stat.st_mtime) in done:
+            skipped += 1
+            continue
+        try:
+            if relative_path.as_posix() in mapping:
+                record = mapping[relative_path.as_posix()]
+            elif layout:
+                record = metadata_from_path(relative_path, layout)
+            else:
+                raise ValueError("not listed in the mapping file")
+            check_document_name(record["file_name"])
+            # Keys with IDs are derived from the source path, so a file changed
+            # since an earlier run replaces the document that run created
+            pdf_key = new_document_key(
+                record["file_name"],
+                record["departments"],
+                doc_id=stable_document_id(f"ingest/{relative_path.as_posix()}")
+            )
+            if pdf_key in keys:
+                raise ValueError(f"same name as {keys[pdf_key]}")
+        except ValueError as e:
+            failures.append((relative_path, e))
+            continue
+        keys[pdf_key] = relative_path
+        jobs.append((path, relative_path, stat, record, pdf_key))
+
+    # Flat keys are made from names alone, so a file could replace a document
+    # uploaded some other way; only the tool's own earlier uploads are replaced
+    # unless --replace-existing is given
+    if not args.replace_existing and any(is_flat_key(job[4]) for job in jobs):
+        existing = set(list_pdf_keys(BUCKET_NAME, DOCUMENTS_PREFIX)) - uploaded_keys
+        kept = []
+        for job in jobs:
+            if job[4] in existing:
+                failures.append((job[1], ValueError(f"would replace {job[4]}, which was not uploaded by this tool")))
+            else:
+                kept.append(job)
+        jobs = kept
+
+    print(f"{len(jobs)} file(s) to upload, {skipped} already done, {len(failures)} with problems.")
+    for relative_path, error in failures:
+        print(f"  {relative_path}: {error}", file=sys.stderr)
+    if args.dry_run:
+        for _, relative_path, _, _, pdf_key in jobs:
+            print(f"  {relative_path} -> {pdf_key}")
+        return 1 if failures else 0
+
+    known_hashes, _ = read_hash_index()
+    claimed_hashes = dict(known_hashes)
+    lock = threading.Lock()
+    pending = []  # Change records not yet in the indexes
+    counted = 0  # How many of them are already in the statistics
+    finished = []  # Checkpoint entries waiting for their files to be in the indexes
+
+    def upload(job):
+        path, relative_path, stat, record, pdf_key = job
+        with open(path, "rb") as f:
+            content_hash = sha256_of(f)
+            with lock:
+                duplicate_of = claimed_hashes.setdefault(content_hash, pdf_key)
+            if duplicate_of != pdf_key and not args.upload_duplicates:
+                return content_hash, duplicate_of, None, None, None
+            # A file may replace a document already stored at its key, e.g. one
+            # from an earlier run, whose metadata and size the statistics and
+            # change feed need
+            before = previous_size = None
+            try:
+                before = get_metadata(pdf_key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                    raise
+            if before is not None:
+                previous_size = document_sizes([pdf_key])[pdf_key]
+            extract_error = upload_document(
+                f,
+                record["file_name"],
+                record["departments"],
+                record["semesters"],
+                record["tags"],
+                content_hash=content_hash,
+                skip_pdf=known_hashes.get(content_hash) == pdf_key,
+                extract_source=str(path) if extract else None,
+                pdf_key=pdf_key,
+                thumbnail_source=str(path) if thumbnails else None
+            )
+        return content_hash, None, extract_error, before, previous_size
+
+    # Failed index updates keep their entries and are tried again at the next
+    # flush. The other indexes can take the same entry twice; the statistics
+    # would count it twice, so they only get the entries not counted yet.
+    # Files only go into the checkpoint once they are in every index, so a run
+    # that stops before that uploads them again. Returns False on failure.
+    def flush_indexes(checkpoint):
+        nonlocal counted
+        if pending:
+            try:
+                if MANIFEST_ENABLED:
+                    update_manifest({change["key"]: change["after"] for change in pending})
+                update_hash_index(record_content_hashes({change["key"]: change["content_hash"] for change in pending}))
+                if counted < len(pending):
+                    update_catalog_stats(lambda stats: count_changes(stats, pending[counted:]))
+                    counted = len(pending)
+                append_changes(pending)
+            except Exception as e:
+                print(f"Error updating the manifest, hash index, statistics or change feed: {e}", file=sys.stderr)
+                return False
+            pending.clear()
+            counted = 0
+        for entry in finished:
+            checkpoint.write(json.dumps(entry) + "\n")
+        checkpoint.flush()
+        finished.clear()
+        return True
+
+    uploaded = 0
+    with open(args.checkpoint, "a", encoding="utf-8") as checkpoint, \
+            ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_throttled, upload, job): job for job in jobs}
+        for count, future in enumerate(as_completed(futures), start=1):
+            path, relative_path, stat, record, pdf_key = futures[future]
+            try:
+                content_hash, duplicate_of, extract_error, before, previous_size = future.result()
+            except Exception as e:
+                failures.append((relative_path, e))
+                print(f"[{count}/{len(jobs)}] FAILED {relative_path}: {e}", file=sys.stderr)
+                continue
+
+            if duplicate_of:
+                print(f"[{count}/{len(jobs)}] skipped {relative_path}: same content as {duplicate_of}")
+            else:
+                uploaded += 1
+                pending.append(change_record(
+                    "upload", pdf_key, content_hash, before, record,
+                    size=stat.st_size, previous_size=previous_size
+                ))
+                print(f"[{count}/{len(jobs)}] uploaded {relative_path} -> {pdf_key}")
+                if extract_error:
+                    print(f"  text of {relative_path} could not be extracted: {extract_error}", file=sys.stderr)
+
+            finished.append({
+                "path": relative_path.as_posix(),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "key": pdf_key,
+            })
+            if len(finished) >= INDEX_FLUSH_EVERY:
+                flush_indexes(checkpoint)
+        flushed = flush_indexes(checkpoint)
+
+    print(f"Uploaded {uploaded} of {len(jobs)} file(s); {len(failures)} failed.")
+    if not flushed:
+        print(f"{len(finished)} file(s) are not in the indexes yet and will be uploaded again by the next run.",
+              file=sys.stderr)
+    return 1 if failures or not flushed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
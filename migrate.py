@@ -0,0 +1,184 @@
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+
+# Keep Streamlit quiet about running outside "streamlit run"
+import streamlit.logger
+streamlit.logger.set_log_level("error")
+
+from streamlit_app import (
+    BUCKET_NAME,
+    DOCUMENTS_PREFIX,
+    KEY_LAYOUT,
+    KEY_LAYOUTS,
+    MANIFEST_ENABLED,
+    UPLOAD_WORKERS,
+    append_changes,
+    change_record,
+    copy_document,
+    delete_documents,
+    is_flat_key,
+    list_pdf_keys,
+    metadata_key,
+    new_document_key,
+    object_exists,
+    parse_metadata_csv,
+    run_throttled,
+    s3,
+    stable_document_id,
+    update_hash_index,
+    update_manifest,
+)
+
+# How many copied documents are collected before the indexes are pointed at
+# the new keys and the originals deleted
+BATCH_SIZE = 100
+
+# Function to read a document's metadata CSV together with its ETag, so an
+# edit made while the document is being copied can be noticed
+def read_metadata(pdf_key):
+    response = s3.get_object(Bucket=BUCKET_NAME, Key=metadata_key(pdf_key))
+    return parse_metadata_csv(response["Body"].read().decode("utf-8")), response["ETag"]
+
+# Function to copy one flat document to its key in the new layout. The ID is
+# derived from the old key, so a run that was interrupted copies each
+# document to the same key again instead of making a second copy. Also
+# returns whether that key was already there, as the indexes may point at it.
+def migrate_document(old_key, layout):
+    record, etag = read_metadata(old_key)
+    new_key = new_document_key(record["file_name"], record["departments"], layout, stable_document_id(old_key))
+    existed = object_exists(new_key)
+    copy_document(old_key, new_key, record)
+    return new_key, record, etag, existed
+
+# Function to check that a CSV has not changed since it was copied
+def metadata_unchanged(pdf_key, etag):
+    try:
+        return s3.head_object(Bucket=BUCKET_NAME, Key=metadata_key(pdf_key))["ETag"] == etag
+    except ClientError:
+        return False
+
+# Function to delete copies that will not be used, the same way copy_document
+# cleans up after a failed copy. Copies an earlier run left in place are kept,
+# since the indexes may already point at them.
+def discard_copies(items):
+    _, errors = delete_documents([new_key for _, new_key, _, _, existed in items if not existed])
+    for key, error in errors:
+        print(f"  {key} could not be removed: {error}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move documents stored as documents/<name>.pdf to a sharded key layout with stable IDs. "
+                    "The app can stay in use; running the tool again after an interruption finishes the job."
+    )
+    parser.add_argument(
+        "--layout",
+        default=KEY_LAYOUT,
+        choices=[layout for layout in KEY_LAYOUTS if layout != "flat"],
+        help="target layout (default: KEY_LAYOUT)"
+    )
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="documents copied in parallel")
+    parser.add_argument("--dry-run", action="store_true", help="only count the documents that would move")
+    args = parser.parse_args(argv)
+    if args.layout == "flat":
+        parser.error("set --layout (or KEY_LAYOUT) to hash or department")
+
+    old_keys = [key for key in list_pdf_keys(BUCKET_NAME, DOCUMENTS_PREFIX) if is_flat_key(key)]
+    print(f"{len(old_keys)} document(s) to move to the {args.layout} layout.")
+    if args.dry_run or not old_keys:
+        return 0
+
+    failures = []
+    moved = 0
+
+    # The indexes point at the new keys before any original is deleted, so
+    # whatever step a run stops at, the next run can pick up from there
+    def finish_batch(batch):
+        nonlocal moved
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            unchanged = list(pool.map(lambda item: metadata_unchanged(item[0], item[3]), batch))
+        ready = []
+        edited = []
+        for item, same in zip(batch, unchanged):
+            if same:
+                ready.append(item)
+            else:
+                edited.append(item)
+                print(f"  {item[0]} was edited while it was copied; run the tool again to move it", file=sys.stderr)
+        discard_copies(edited)
+        if not ready:
+            return
+
+        new_keys = {old_key: new_key for old_key, new_key, _, _, _ in ready}
+        old_keys = {new_key: old_key for old_key, new_key in new_keys.items()}
+        hashes = {}
+        def change(index):
+            for content_hash, key in index.items():
+                if key in new_keys:
+                    index[content_hash] = new_keys[key]
+                    hashes[key] = content_hash
+        def undo_change(index):
+            for content_hash, key in index.items():
+                if key in old_keys:
+                    index[content_hash] = old_keys[key]
+
+        # Steps that went through are undone before the copies are deleted
+        undo = []
+        try:
+            if MANIFEST_ENABLED:
+                changes = {}
+                originals = {}
+                for old_key, new_key, record, _, _ in ready:
+                    changes[old_key] = None
+                    changes[new_key] = record
+                    originals[old_key] = record
+                    originals[new_key] = None
+                update_manifest(changes)
+                undo.append(lambda: update_manifest(originals))
+            update_hash_index(change)
+            undo.append(lambda: update_hash_index(undo_change))
+            append_changes([
+                change_record("rename", new_key, hashes.get(old_key), record, record, previous_key=old_key)
+                for old_key, new_key, record, _, _ in ready
+            ])
+        except Exception as e:
+            print(f"Error updating the manifest, hash index or change feed: {e}", file=sys.stderr)
+            failures.extend((old_key, e) for old_key in new_keys)
+            try:
+                for step in reversed(undo):
+                    step()
+            except Exception as e:
+                print(f"  could not point the indexes back at the originals, so the copies are kept: {e}", file=sys.stderr)
+                return
+            discard_copies(ready)
+            return
+
+        _, errors = delete_documents(list(new_keys))
+        for key, error in errors:
+            print(f"  copied, but {key} could not be removed: {error}", file=sys.stderr)
+        moved += len(ready) - len({key for key, _ in errors if key in new_keys})
+
+    batch = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_throttled, migrate_document, key, args.layout): key for key in old_keys}
+        for count, future in enumerate(as_completed(futures), start=1):
+            old_key = futures[future]
+            try:
+                new_key, record, etag, existed = future.result()
+            except Exception as e:
+                failures.append((old_key, e))
+                print(f"[{count}/{len(old_keys)}] FAILED {old_key}: {e}", file=sys.stderr)
+                continue
+            print(f"[{count}/{len(old_keys)}] copied {old_key} -> {new_key}")
+            batch.append((old_key, new_key, record, etag, existed))
+            if len(batch) >= BATCH_SIZE:
+                finish_batch(batch)
+                batch = []
+    finish_batch(batch)
+
+    print(f"Moved {moved} of {len(old_keys)} document(s); {len(failures)} failed.")
+    return 1 if failures or moved < len(old_keys) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
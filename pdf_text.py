@@ -0,0 +1,97 @@
+import re
+import logging
+from io import BytesIO
+from datetime import datetime
+
+# pypdf is optional; without it the text extraction stage is switched off
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+EXTRACTION_AVAILABLE = pypdf is not None
+
+# pypdfium2 is optional too; without it no thumbnails are made. It renders
+# pages into Pillow images, which it needs as well.
+try:
+    import pypdfium2
+    import PIL.Image
+except ImportError:
+    pypdfium2 = None
+THUMBNAILS_AVAILABLE = pypdfium2 is not None
+
+# JPEG quality of thumbnails; a 160 pixel wide page is a few KB
+THUMBNAIL_QUALITY = 70
+
+# Linearized PDFs start with a dictionary giving, as /E, the offset at which
+# the data needed to show the first page ends
+LINEARIZED_FIRST_PAGE_END = re.compile(rb"/Linearized\b.*?/E\s+(\d+)", re.DOTALL)
+
+# Version of the sidecar layout, bumped when fields change
+SIDECAR_VERSION = 1
+
+# Document info fields copied into the sidecar, by their PDF name
+INFO_FIELDS = {
+    "/Title": "title",
+    "/Author": "author",
+    "/Subject": "subject",
+    "/Keywords": "keywords",
+    "/Creator": "creator",
+    "/Producer": "producer",
+    "/CreationDate": "created",
+    "/ModDate": "modified",
+}
+
+# Function to read the text of every page, the page count and the document
+# info of a PDF, given as bytes or as a path. It runs in a separate process,
+# so it lives in this small module that does not import Streamlit or boto3.
+def extract_pdf_info(source):
+    # pypdf logs a warning for every minor defect, and scanned files have many
+    logging.getLogger("pypdf").setLevel(logging.ERROR)
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    reader = pypdf.PdfReader(source)
+    encrypted = reader.is_encrypted
+    if encrypted:
+        reader.decrypt("")  # Many PDFs are encrypted with an empty user password
+
+    info = {}
+    for field, name in INFO_FIELDS.items():
+        value = (reader.metadata or {}).get(field)
+        if value is not None:
+            info[name] = value.isoformat() if isinstance(value, datetime) else str(value)
+
+    pages = []
+    for page in reader.pages:
+        try:
+            pages.append(page.extract_text() or "")
+        except Exception:
+            pages.append("")  # One broken page should not lose the rest
+    return {
+        "version": SIDECAR_VERSION,
+        "extractor": f"pypdf {pypdf.__version__}",
+        "page_count": len(pages),
+        "encrypted": encrypted,
+        "info": info,
+        "characters": sum(len(text) for text in pages),
+        "pages": pages,
+    }
+
+# Function to draw the first page of a PDF, given as bytes or as a path, as a
+# JPEG the given number of pixels wide. Runs in the same process pool as
+# extract_pdf_info.
+def render_thumbnail(source, width):
+    document = pypdfium2.PdfDocument(source)
+    try:
+        page = document[0]
+        image = page.render(scale=width / page.get_width()).to_pil()
+        output = BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        return output.getvalue()
+    finally:
+        document.close()
+
+# Function to find where the first page ends in a linearized PDF, given the
+# first bytes of the file. Returns None for PDFs that are not linearized.
+def first_page_end(head):
+    match = LINEARIZED_FIRST_PAGE_END.search(head[:1024])
+    return int(match.group(1)) if match else None
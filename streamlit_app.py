@@ -1,299 +1,3187 @@
-import os
-import csv
-import streamlit as st
-import boto3
-from io import StringIO
-
-# Initialize S3 client
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION")
-)
-
-# Predefined tags
-PREDEFINED_TAGS = ["Textbook", "Lecture Notes", "Research Paper", "Policy", "Announcement", "Notice", "Rulebook", "Other"]
-
-# Predefined departments
-DEPARTMENTS = [
-    "Department of Computer Science",
-    "Department of Mechanical Engineering",
-    "Department of Electrical Engineering",
-    "Department of Civil Engineering",
-    "Department of Mathematics",
-    "Department of Physics",
-    "Department of Chemistry",
-    "Department of Humanities",
-]
-
-# Predefined semesters
-SEMESTERS = ["S1", "S2", "S3", "S4", "S5", "S6", "S7", "S8", "Supply"]
-
-# Streamlit app
-st.title("PDF Upload and Management")
-
-# Initialize session state for page navigation
-if "page" not in st.session_state:
-    st.session_state.page = "Home"
-
-# Sidebar for navigation
-st.sidebar.title("Admin")
-if st.sidebar.button("Home"):
-    st.session_state.page = "Home"
-if st.sidebar.button("Upload Files"):
-    st.session_state.page = "Upload Files"
-if st.sidebar.button("Edit Existing Files"):
-    st.session_state.page = "Edit Existing Files"
-
-# Function to upload file to S3
-def upload_to_s3(file, bucket_name, object_name):
-    try:
-        s3.upload_fileobj(file, bucket_name, object_name)
-        return True
-    except Exception as e:
-        st.error(f"Error uploading file to S3: {e}")
-        return False
-
-def generate_metadata_csv(file_name, departments, semesters, tags):
-    # Replace "All" with the full list of values
-    if "All" in departments:
-        departments = DEPARTMENTS
-    if "All" in semesters:
-        semesters = SEMESTERS
-    
-    # Create a CSV string with headers and data
-    csv_output = StringIO()
-    writer = csv.writer(csv_output)
-    
-    # Write headers
-    writer.writerow(["file_name", "departments", "semesters", "tags"])
-    
-    # Write data
-    writer.writerow([
-        file_name,                     # file_name
-        ",".join(departments),         # departments
-        ",".join(semesters),           # semesters
-        ",".join(tags)                 # tags
-    ])
-    
-    # Return the CSV string
-    return csv_output.getvalue()
-
-# Homepage
-def homepage():
-    st.write("Welcome to the PDF Upload and Management System!")
-    st.write("Use the navigation sidebar to switch between pages.")
-
-# Upload page
-def upload_page():
-    st.write("### Upload PDFs")
-    
-    # File uploader for multiple PDFs
-    uploaded_files = st.file_uploader("Upload PDFs", type="pdf", accept_multiple_files=True)
-    
-    # Display uploaded files in a grid
-    if uploaded_files:
-        st.subheader("Uploaded PDFs")
-        cols = st.columns(2)  # 2-column grid
-        for i, uploaded_file in enumerate(uploaded_files):
-            with cols[i % 2]:  # Distribute files across columns
-                st.write(f"**File {i + 1}**")
-                
-                # Display file name (editable, without .pdf extension)
-                file_name = uploaded_file.name.replace(".pdf", "")
-                new_name = st.text_input(f"Name for File {i + 1}", value=file_name, key=f"name_{i}")
-                
-                # Department selection (multi-select dropdown with "All" option)
-                departments = st.multiselect(
-                    f"Department(s) for File {i + 1}",
-                    options=["All"] + DEPARTMENTS,  # Add "All" option
-                    default=[],  # Default to empty
-                    key=f"dept_{i}"
-                )
-                # If "All" is selected, choose all departments
-                if "All" in departments:
-                    departments = DEPARTMENTS
-                
-                # Semester selection (multi-select dropdown with "All" option)
-                semesters = st.multiselect(
-                    f"Semester(s) for File {i + 1}",
-                    options=["All"] + SEMESTERS,  # Add "All" option
-                    default=[],  # Default to empty
-                    key=f"sem_{i}"
-                )
-                # If "All" is selected, choose all semesters
-                if "All" in semesters:
-                    semesters = SEMESTERS
-                
-                # Tags selection (multi-select dropdown)
-                tags = st.multiselect(
-                    f"Tags for File {i + 1}",
-                    options=PREDEFINED_TAGS,
-                    default=[],  # Default to empty
-                    key=f"tags_{i}"
-                )
-                
-                st.write("---")  # Separator between files
-    
-    # Upload button
-    if st.button("Upload All Files"):
-        if uploaded_files:
-            for i, uploaded_file in enumerate(uploaded_files):
-                # Rename the file
-                new_name = st.session_state[f"name_{i}"]
-                new_file_name = f"{new_name}.pdf"
-                
-                # Generate metadata CSV
-                metadata = generate_metadata_csv(
-                    new_name,  # File name without extension
-                    st.session_state[f"dept_{i}"],
-                    st.session_state[f"sem_{i}"],
-                    st.session_state[f"tags_{i}"]
-                )
-                
-                # Upload the renamed PDF file to S3
-                pdf_object_name = f"documents/{new_file_name}"
-                if upload_to_s3(uploaded_file, "ragnroll", pdf_object_name):
-                    st.success(f"File {new_file_name} uploaded to S3.")
-                    
-                    # Upload the metadata CSV file to S3
-                    # Upload the metadata CSV file to S3
-                    metadata_object_name = f"documents/{new_name}.csv"
-                    try:
-                        # Generate the CSV metadata
-                        csv_metadata = generate_metadata_csv(
-                            new_name,  # File name without extension
-                            st.session_state[f"dept_{i}"],
-                            st.session_state[f"sem_{i}"],
-                            st.session_state[f"tags_{i}"]
-                        )
-                        
-                        # Upload the CSV file to S3
-                        s3.put_object(
-                            Bucket="ragnroll",
-                            Key=metadata_object_name,
-                            Body=csv_metadata
-                        )
-                        st.success(f"Metadata for {new_file_name} uploaded to S3.")
-                    except Exception as e:
-                        st.error(f"Error uploading metadata for {new_file_name}: {e}")
-        else:
-            st.warning("No files uploaded.")
-
-# Edit page
-def edit_page():
-    st.write("### Edit Existing Files")
-
-    # List all files in the S3 bucket
-    try:
-        response = s3.list_objects_v2(Bucket="ragnroll", Prefix="documents/")
-        if "Contents" in response:
-            files = [obj["Key"] for obj in response["Contents"] if obj["Key"].endswith(".pdf")]
-        else:
-            st.warning("No files found in the S3 bucket.")
-            return
-    except Exception as e:
-        st.error(f"Error listing files from S3: {e}")
-        return
-
-    # Dropdown to select a file
-    selected_file = st.selectbox("Select a file to edit", files, index=None)
-
-    if selected_file:
-        # Fetch metadata CSV file
-        metadata_file = selected_file.replace(".pdf", ".csv")
-        try:
-            metadata_response = s3.get_object(Bucket="ragnroll", Key=metadata_file)
-            metadata_content = metadata_response["Body"].read().decode("utf-8")
-            
-            # Parse the CSV content
-            reader = csv.reader(StringIO(metadata_content))
-            headers = next(reader)  # Skip headers
-            file_name, departments, semesters, tags = next(reader)
-            
-            # Split comma-separated values into lists
-            departments = departments.split(",")
-            semesters = semesters.split(",")
-            tags = tags.split(",")
-        except Exception as e:
-            st.error(f"Error fetching metadata for {selected_file}: {e}")
-            metadata = {}
-
-        # Display file name (editable)
-        file_name = file_name or selected_file.split("/")[-1].replace(".pdf", "")
-        new_name = st.text_input("File Name", value=file_name, key="edit_name")
-
-        # Department selection (multi-select dropdown with "All" option)
-        departments = st.multiselect(
-            "Department(s)",
-            options=["All"] + DEPARTMENTS,
-            default=departments,
-            key="edit_dept"
-        )
-        if "All" in departments:
-            departments = DEPARTMENTS
-
-        # Semester selection (multi-select dropdown with "All" option)
-        semesters = st.multiselect(
-            "Semester(s)",
-            options=["All"] + SEMESTERS,
-            default=semesters,
-            key="edit_sem"
-        )
-        if "All" in semesters:
-            semesters = SEMESTERS
-
-        # Tags selection (multi-select dropdown)
-        tags = st.multiselect(
-            "Tags",
-            options=PREDEFINED_TAGS,
-            default=tags,
-            key="edit_tags"
-        )
-
-        # Save changes button
-        if st.button("Save Changes"):
-            try:
-                # Generate updated metadata CSV
-                updated_metadata_csv = generate_metadata_csv(
-                    new_name,
-                    departments,
-                    semesters,
-                    tags
-                )
-
-                # Upload updated metadata CSV file to S3
-                s3.put_object(
-                    Bucket="ragnroll",
-                    Key=metadata_file,
-                    Body=updated_metadata_csv
-                )
-                st.success("Metadata updated successfully!")
-            except Exception as e:
-                st.error(f"Error updating metadata: {e}")
-
-        # Delete file button
-        if st.button("Delete File"):
-            try:
-                # Delete PDF file from S3
-                s3.delete_object(Bucket="ragnroll", Key=selected_file)
-                
-                # Delete metadata CSV file from S3
-                s3.delete_object(Bucket="ragnroll", Key=metadata_file)
-                
-                st.success(f"File {selected_file} and its metadata deleted successfully!")
-                # Rerun the script to refresh the file list
-                st.rerun()
-            except Exception as e:
-                st.error(f"Error deleting file: {e}")
-    else:
-        st.warning("No file selected.")
-
-# Page routing
-if st.session_state.page == "Home":
-    homepage()
-elif st.session_state.page == "Upload Files":
-    upload_page()
-elif st.session_state.page == "Edit Existing Files":
-    edit_page()
\ No newline at end of file
+import os
+import csv
+import gzip
+import re
+import json
+import time
+import uuid
+import random
+import shutil
+import hashlib
+import weakref
+import tempfile
+import threading
+import multiprocessing
+import streamlit as st
+import boto3
+from io import StringIO
+from collections import deque, OrderedDict
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from pdf_text import EXTRACTION_AVAILABLE, THUMBNAILS_AVAILABLE, extract_pdf_info, first_page_end, render_thumbnail
+
+# S3 connection tuning. The pool should be large enough for every upload
+# worker and multipart part in flight at once.
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "60"))
+
+# Attempts botocore makes for each request, with its own jittered backoff
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
+
+# Bulk work (uploads, renames, deletes, index rebuilds) shares one concurrency
+# limit across all sessions. It grows while S3 keeps up and shrinks when S3
+# throttles or requests without a large body take longer than
+# S3_LATENCY_TARGET seconds. Throttled work is tried up to S3_TASK_ATTEMPTS
+# times, waiting a random time of up to S3_BACKOFF_BASE * 2^attempt seconds
+# (at most S3_BACKOFF_CAP) between tries.
+BULK_MIN_CONCURRENCY = int(os.getenv("BULK_MIN_CONCURRENCY", "1"))
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", str(S3_MAX_POOL_CONNECTIONS)))
+BULK_START_CONCURRENCY = int(os.getenv("BULK_START_CONCURRENCY", "8"))
+S3_LATENCY_TARGET = float(os.getenv("S3_LATENCY_TARGET", "1.0"))
+S3_TASK_ATTEMPTS = int(os.getenv("S3_TASK_ATTEMPTS", "5"))
+S3_BACKOFF_BASE = float(os.getenv("S3_BACKOFF_BASE", "0.2"))
+S3_BACKOFF_CAP = float(os.getenv("S3_BACKOFF_CAP", "20"))
+
+# The limit is cut at most once per this many seconds, so one burst of
+# throttled responses counts as a single signal
+BULK_DECREASE_INTERVAL = 1.0
+
+# Error codes S3 uses when it wants the client to slow down
+THROTTLING_CODES = {
+    "SlowDown",
+    "ServiceUnavailable",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestTimeout",
+    "InternalError",
+    "503",
+}
+THROTTLING_STATUSES = {429, 500, 503}
+
+# Number of recent samples kept per S3 operation and per page for percentiles
+METRICS_SAMPLE_SIZE = int(os.getenv("METRICS_SAMPLE_SIZE", "1000"))
+
+# Function to hold latency metrics for S3 operations and page renders. Shared
+# by every session so the panel shows what the whole server is doing.
+@st.cache_resource
+def get_metrics():
+    return {"lock": threading.Lock(), "s3": {}, "page": {}}
+
+# Function to record one timed event; kind is "s3" or "page"
+def record_metric(kind, name, seconds, size=0, retries=0, error=False):
+    metrics = get_metrics()
+    with metrics["lock"]:
+        entry = metrics[kind].get(name)
+        if entry is None:
+            entry = {
+                "samples": deque(maxlen=METRICS_SAMPLE_SIZE),
+                "count": 0,
+                "seconds": 0.0,
+                "bytes": 0,
+                "retries": 0,
+                "errors": 0,
+            }
+            metrics[kind][name] = entry
+        entry["samples"].append(seconds)
+        entry["count"] += 1
+        entry["seconds"] += seconds
+        entry["bytes"] += size
+        entry["retries"] += retries
+        entry["errors"] += int(error)
+
+# Function to time every call made by an S3 client through botocore events.
+# The timing covers retries; bytes are the request body for uploads and the
+# response body length for downloads.
+def instrument_client(client):
+    def before_call(model, params, context, **kwargs):
+        body = params.get("body")
+        if isinstance(body, (bytes, bytearray, str)):
+            size = len(body)
+        elif hasattr(body, "seek") and hasattr(body, "tell"):
+            position = body.tell()
+            body.seek(0, os.SEEK_END)
+            size = body.tell() - position
+            body.seek(position)
+        else:
+            size = 0
+        context["metrics"] = {"operation": model.name, "start": time.perf_counter(), "bytes": size}
+
+    def after_call(http_response, parsed, context, **kwargs):
+        call = context.pop("metrics", None)
+        if call is None:
+            return
+        seconds = time.perf_counter() - call["start"]
+        size = call["bytes"] + int(http_response.headers.get("Content-Length") or 0)
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        record_metric(
+            "s3",
+            call["operation"],
+            seconds,
+            size=size,
+            retries=retries,
+            error=http_response.status_code >= 400
+        )
+        throttled = (
+            retries > 0
+            or http_response.status_code in THROTTLING_STATUSES
+            or parsed.get("Error", {}).get("Code") in THROTTLING_CODES
+        )
+        # Large bodies are slow because of their size, not because S3 is busy
+        slow = call["bytes"] < MB and seconds > S3_LATENCY_TARGET
+        report_s3_outcome(throttled, slow)
+
+    def after_call_error(context, **kwargs):
+        call = context.pop("metrics", None)
+        if call is not None:
+            record_metric("s3", call["operation"], time.perf_counter() - call["start"], error=True)
+            report_s3_outcome(True, False)  # Timeouts and dropped connections
+
+    client.meta.events.register("before-call.s3", before_call)
+    client.meta.events.register("after-call.s3", after_call)
+    client.meta.events.register("after-call-error.s3", after_call_error)
+
+# Function to get a percentile (0-100) of a list of samples by nearest rank
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+# Function to summarise the recorded metrics as rows for the metrics panel
+def metrics_summary():
+    metrics = get_metrics()
+    rows = []
+    with metrics["lock"]:
+        for kind in ("s3", "page"):
+            for name, entry in sorted(metrics[kind].items()):
+                rows.append({
+                    "kind": kind,
+                    "name": name,
+                    "count": entry["count"],
+                    "p50 ms": round(percentile(entry["samples"], 50) * 1000, 1),
+                    "p95 ms": round(percentile(entry["samples"], 95) * 1000, 1),
+                    "MB": round(entry["bytes"] / MB, 2),
+                    "retries": entry["retries"],
+                    "errors": entry["errors"],
+                })
+    return rows
+
+# Function to export the recorded metrics in the Prometheus text format
+def metrics_prometheus():
+    metrics = get_metrics()
+    lines = []
+    with metrics["lock"]:
+        for kind, metric, label in (("s3", "ragnroll_s3_request_seconds", "operation"),
+                                    ("page", "ragnroll_page_render_seconds", "page")):
+            lines.append(f"# TYPE {metric} summary")
+            for name, entry in sorted(metrics[kind].items()):
+                for quantile in (0.5, 0.95):
+                    value = percentile(entry["samples"], quantile * 100)
+                    lines.append(f'{metric}{{{label}="{name}",quantile="{quantile}"}} {value:.6f}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {entry["seconds"]:.6f}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {entry["count"]}')
+        for field in ("bytes", "retries", "errors"):
+            metric = f"ragnroll_s3_{field}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for name, entry in sorted(metrics["s3"].items()):
+                lines.append(f'{metric}{{operation="{name}"}} {entry[field]}')
+    controller = get_rate_controller()
+    lines.append("# TYPE ragnroll_bulk_concurrency_limit gauge")
+    lines.append(f"ragnroll_bulk_concurrency_limit {controller['limit']:.2f}")
+    lines.append("# TYPE ragnroll_bulk_in_flight gauge")
+    lines.append(f"ragnroll_bulk_in_flight {controller['in_flight']}")
+    return "\n".join(lines) + "\n"
+
+# Function to hold the concurrency limit for bulk work, shared by every session
+@st.cache_resource
+def get_rate_controller():
+    return {
+        "condition": threading.Condition(),
+        "limit": float(BULK_START_CONCURRENCY),
+        "in_flight": 0,
+        "last_decrease": 0.0,
+    }
+
+# Function to adjust the bulk concurrency limit after an S3 request. Throttling
+# halves the limit and slow responses trim it by a tenth; otherwise, while all
+# slots are in use, it grows by about one per full round of requests.
+def report_s3_outcome(throttled, slow):
+    controller = get_rate_controller()
+    with controller["condition"]:
+        now = time.monotonic()
+        if throttled or slow:
+            if now - controller["last_decrease"] >= BULK_DECREASE_INTERVAL:
+                factor = 0.5 if throttled else 0.9
+                controller["limit"] = max(BULK_MIN_CONCURRENCY, controller["limit"] * factor)
+                controller["last_decrease"] = now
+        elif controller["in_flight"] >= int(controller["limit"]):
+            controller["limit"] = min(BULK_MAX_CONCURRENCY, controller["limit"] + 1 / controller["limit"])
+            controller["condition"].notify_all()
+
+# Function to tell whether an error means S3 is throttling or overloaded
+def is_throttling_error(error):
+    if isinstance(error, ClientError):
+        return (
+            error.response.get("Error", {}).get("Code") in THROTTLING_CODES
+            or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") in THROTTLING_STATUSES
+        )
+    if isinstance(error, S3UploadFailedError):
+        # The transfer manager only keeps the message of the failed request
+        return any(f"({code})" in str(error) for code in THROTTLING_CODES)
+    return False
+
+# Function to wait before trying throttled work again, with full jitter
+def backoff(attempt):
+    time.sleep(random.uniform(0, min(S3_BACKOFF_CAP, S3_BACKOFF_BASE * 2 ** attempt)))
+
+# Function to call fn, trying it again with backoff while S3 throttles it.
+# Other errors, and throttling on the last attempt, are raised.
+def with_retries(fn, *args, **kwargs):
+    for attempt in range(S3_TASK_ATTEMPTS):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_throttling_error(e) or attempt == S3_TASK_ATTEMPTS - 1:
+                raise
+        backoff(attempt)
+
+# Function to run one unit of bulk work (one file uploaded, renamed, hashed,
+# ...) within the shared concurrency limit, with retries. Thread pools may be
+# larger than the limit; extra workers wait here for a free slot. Work run this
+# way must not call run_throttled again, or it could wait on its own slot.
+def run_throttled(fn, *args, **kwargs):
+    controller = get_rate_controller()
+    with controller["condition"]:
+        while controller["in_flight"] >= int(controller["limit"]):
+            controller["condition"].wait()
+        controller["in_flight"] += 1
+    try:
+        return with_retries(fn, *args, **kwargs)
+    finally:
+        with controller["condition"]:
+            controller["in_flight"] -= 1
+            controller["condition"].notify_all()
+
+# Function to create the S3 client. It is built on the first run and then
+# shared by every session and rerun, so its warm connections are reused.
+# S3_ENDPOINT_URL points it at an S3-compatible server instead of AWS, e.g.
+# MinIO for local testing.
+@st.cache_resource
+def get_s3_client():
+    client = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=os.getenv("AWS_REGION"),
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=Config(
+            signature_version="s3v4",
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            connect_timeout=S3_CONNECT_TIMEOUT,
+            read_timeout=S3_READ_TIMEOUT,
+            tcp_keepalive=True,
+            retries={"mode": "standard", "max_attempts": S3_MAX_ATTEMPTS}
+        )
+    )
+    instrument_client(client)
+    return client
+
+# Initialize S3 client
+s3 = get_s3_client()
+
+# Predefined tags
+PREDEFINED_TAGS = ["Textbook", "Lecture Notes", "Research Paper", "Policy", "Announcement", "Notice", "Rulebook", "Other"]
+
+# Predefined departments
+DEPARTMENTS = [
+    "Department of Computer Science",
+    "Department of Mechanical Engineering",
+    "Department of Electrical Engineering",
+    "Department of Civil Engineering",
+    "Department of Mathematics",
+    "Department of Physics",
+    "Department of Chemistry",
+    "Department of Humanities",
+]
+
+# Predefined semesters
+SEMESTERS = ["S1", "S2", "S3", "S4", "S5", "S6", "S7", "S8", "Supply"]
+
+# Metadata fields that documents can be filtered by
+FACETS = ("departments", "semesters", "tags")
+
+# Metadata CSVs kept in memory, keyed by object key and ETag. Entries checked
+# within METADATA_FRESH_SECONDS are used as-is; older ones are revalidated with
+# a conditional GET that only downloads the CSV again if it changed.
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "20000"))
+METADATA_FRESH_SECONDS = float(os.getenv("METADATA_FRESH_SECONDS", "30"))
+
+# How many files of the filtered list have their metadata fetched ahead of time
+METADATA_PREFETCH_LIMIT = int(os.getenv("METADATA_PREFETCH_LIMIT", "200"))
+METADATA_PREFETCH_WORKERS = int(os.getenv("METADATA_PREFETCH_WORKERS", "8"))
+
+# Append-only log of every upload, edit, rename and delete, for downstream
+# indexers. Each batch of changes is one JSONL object under a date partition,
+# named after the sequence numbers it holds.
+CHANGES_PREFIX = os.getenv("CHANGES_PREFIX", "changes/")
+CHANGES_SEQUENCE_KEY = f"{CHANGES_PREFIX}sequence.json"
+
+# A gap in the sequence older than this is taken to be a write that never
+# landed, and readers move past it
+CHANGES_GAP_TIMEOUT_SECONDS = 300
+
+# S3 bucket and prefix holding the documents
+BUCKET_NAME = "ragnroll"
+DOCUMENTS_PREFIX = "documents/"
+
+# Key layout for new documents. "flat" names keys after the documents,
+# documents/<name>.pdf. "hash" and "department" give every document a stable
+# random ID and spread documents over sub-prefixes: documents/<shard>/<id>.pdf
+# or documents/<department>/<shard>/<id>.pdf, where the shard is the first
+# SHARD_DIGITS hex digits of the ID. Names then live only in the metadata CSV,
+# so renames do not move objects and equal names never overwrite each other.
+# Both kinds of key can exist side by side; see migrate.py.
+KEY_LAYOUTS = ("flat", "hash", "department")
+KEY_LAYOUT = os.getenv("KEY_LAYOUT", "flat")
+SHARD_DIGITS = int(os.getenv("SHARD_DIGITS", "2"))
+
+# How long (in seconds) the cached file list is reused before S3 is listed again
+CATALOG_TTL_SECONDS = int(os.getenv("CATALOG_TTL_SECONDS", "300"))
+
+# Default number of files uploaded in parallel by "Upload All Files"
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+
+# Number of file cards shown at once on the upload page
+UPLOAD_PAGE_SIZE = int(os.getenv("UPLOAD_PAGE_SIZE", "20"))
+
+# Multipart upload tuning: files at or above the threshold are sent in parts of
+# MULTIPART_CHUNKSIZE_MB, with up to MULTIPART_CONCURRENCY parts in flight per file
+MB = 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv("MULTIPART_THRESHOLD_MB", "16")) * MB,
+    multipart_chunksize=int(os.getenv("MULTIPART_CHUNKSIZE_MB", "16")) * MB,
+    max_concurrency=int(os.getenv("MULTIPART_CONCURRENCY", "4")),
+)
+
+# Local file recording in-progress multipart uploads so they can be resumed
+UPLOAD_STATE_FILE = os.getenv("UPLOAD_STATE_FILE", ".upload_state.json")
+
+# Incomplete multipart uploads older than this are treated as orphaned
+STALE_UPLOAD_HOURS = int(os.getenv("STALE_UPLOAD_HOURS", "24"))
+
+# Selected PDFs kept in memory by all sessions together may use at most
+# UPLOAD_MEMORY_BUDGET_MB. Files of UPLOAD_SPOOL_THRESHOLD_MB or more, and any
+# file that would go over the budget, wait on disk in UPLOAD_SPOOL_DIR instead.
+UPLOAD_MEMORY_BUDGET = int(os.getenv("UPLOAD_MEMORY_BUDGET_MB", "512")) * MB
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD_MB", "8")) * MB
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ragnroll-uploads"))
+
+# Optional stage that extracts each PDF's text, page count and document info
+# while it uploads, for the RAG pipeline. The result is stored gzipped next to
+# the PDF as <name>.text.json.gz. Needs pypdf; runs in EXTRACTION_WORKERS
+# processes, one per core by default.
+EXTRACTION_ENABLED = EXTRACTION_AVAILABLE and os.getenv("EXTRACT_TEXT", "1") == "1"
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+SIDECAR_SUFFIX = ".text.json.gz"
+
+# First-page thumbnails, drawn in the same process pool (needs pypdfium2). They
+# are made at upload time, or when a document without one is first previewed,
+# and stored under THUMBNAILS_PREFIX. Previewing a document then reads only its
+# thumbnail, and recently shown ones are kept in memory up to THUMBNAIL_CACHE_MB.
+THUMBNAILS_ENABLED = THUMBNAILS_AVAILABLE and os.getenv("THUMBNAILS", "1") == "1"
+THUMBNAILS_PREFIX = os.getenv("THUMBNAILS_PREFIX", "thumbnails/")
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "160"))
+THUMBNAIL_CACHE_BYTES = int(os.getenv("THUMBNAIL_CACHE_MB", "32")) * MB
+
+# To draw a missing thumbnail, the start of the PDF is read first. Linearized
+# PDFs only need the bytes up to the end of their first page; others are read
+# whole if they are at most THUMBNAIL_MAX_SOURCE_MB, and get no thumbnail otherwise.
+THUMBNAIL_RANGE_BYTES = 64 * 1024
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv("THUMBNAIL_MAX_SOURCE_MB", "32")) * MB
+# The preview grid draws many at once, so it reads at most this much per PDF;
+# larger ones get their thumbnail when they are selected
+THUMBNAIL_GRID_SOURCE_BYTES = int(os.getenv("THUMBNAIL_GRID_SOURCE_MB", "1")) * MB
+
+# Thumbnails shown at once when browsing documents with previews
+THUMBNAIL_GRID_SIZE = 12
+
+# Optional direct uploads: the browser sends PDFs straight to the bucket with
+# presigned POSTs, so their bytes never pass through this server. Each POST
+# only accepts a PDF of at most DIRECT_UPLOAD_MAX_MB at one new key under
+# DOCUMENTS_PREFIX, until it expires. Off by default, since the bucket needs a
+# CORS rule allowing POSTs from the app's address.
+DIRECT_UPLOADS_ENABLED = os.getenv("DIRECT_UPLOADS", "0") == "1"
+DIRECT_UPLOAD_FILES = int(os.getenv("DIRECT_UPLOAD_FILES", "20"))
+DIRECT_UPLOAD_MAX_BYTES = int(os.getenv("DIRECT_UPLOAD_MAX_MB", "1024")) * MB
+DIRECT_UPLOAD_EXPIRY_SECONDS = int(os.getenv("DIRECT_UPLOAD_EXPIRY_SECONDS", "3600"))
+
+# Optional single JSONL manifest holding every document's metadata, kept in
+# sync with the per-file CSVs so the whole catalog can be loaded in one read
+MANIFEST_ENABLED = os.getenv("METADATA_MANIFEST", "false").lower() in ("1", "true", "yes", "on")
+MANIFEST_KEY = os.getenv("MANIFEST_KEY", "index/manifest.jsonl")
+MANIFEST_VERSION = 1
+
+# How many times an update of the manifest or hash index is retried when
+# another admin wrote it first
+INDEX_WRITE_ATTEMPTS = 5
+
+# CopyObject can copy objects up to 5 GB; larger ones need a multipart copy
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+
+# DeleteObjects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+# JSON object mapping the SHA-256 of every stored PDF to its key, used to spot
+# files that are already in the bucket under another name
+HASH_INDEX_KEY = os.getenv("HASH_INDEX_KEY", "index/content-hashes.json")
+
+# JSON object with document counts and bytes for every combination of
+# department, semester and tag, plus recent upload activity, shown on the home
+# page. It is updated from each batch of changes, so its size and the cost of
+# reading it do not grow with the catalog.
+CATALOG_STATS_KEY = os.getenv("CATALOG_STATS_KEY", "index/catalog-stats.json")
+CATALOG_STATS_VERSION = 1
+
+# Days of upload activity and number of latest uploads kept in the statistics
+UPLOAD_ACTIVITY_DAYS = 30
+RECENT_UPLOADS = 10
+
+# Function to tell whether a PDF key uses the flat layout, documents/<name>.pdf
+def is_flat_key(pdf_key):
+    return "/" not in pdf_key[len(DOCUMENTS_PREFIX):]
+
+# Function to get the stable ID of a document, or None for flat keys
+def document_id(pdf_key):
+    if is_flat_key(pdf_key):
+        return None
+    return pdf_key.rsplit("/", 1)[1][:-len(".pdf")]
+
+# Function to derive a document ID from a stable source, e.g. the key a
+# document is migrated from, so that repeated runs pick the same ID
+def stable_document_id(source):
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{BUCKET_NAME}/{source}").hex
+
+# Function to turn a document's departments into a key-safe folder name
+def department_folder(departments):
+    if not departments:
+        return "unassigned"
+    if "All" in departments or set(DEPARTMENTS) <= set(departments):
+        return "all"
+    return re.sub(r"[^a-z0-9]+", "-", departments[0].lower()).strip("-")
+
+# Function to check that a name can be given to a document. Flat keys are made
+# from names, and a "/" in one would give a nested key that reads as an ID.
+def check_document_name(name):
+    if not name or "/" in name:
+        raise ValueError(f"invalid name {name!r}: a name must not be empty or contain '/'")
+
+# Function to choose the PDF key of a new document in the given layout. The
+# department layout files a document under its first department at creation;
+# later edits do not move it.
+def new_document_key(name, departments, layout=KEY_LAYOUT, doc_id=None):
+    if layout == "flat":
+        check_document_name(name)
+        return f"{DOCUMENTS_PREFIX}{name}.pdf"
+    doc_id = doc_id or uuid.uuid4().hex
+    shard = doc_id[:SHARD_DIGITS]
+    if layout == "hash":
+        return f"{DOCUMENTS_PREFIX}{shard}/{doc_id}.pdf"
+    if layout == "department":
+        return f"{DOCUMENTS_PREFIX}{department_folder(departments)}/{shard}/{doc_id}.pdf"
+    raise ValueError(f"unknown key layout {layout!r}; use one of {', '.join(KEY_LAYOUTS)}")
+
+# Function to get the key of a document's metadata CSV, stored next to the PDF
+def metadata_key(pdf_key):
+    return pdf_key[:-len(".pdf")] + ".csv"
+
+# Function to get a document's name. Flat keys carry it; other keys need the
+# metadata record, and show the ID until it is known.
+def document_name(pdf_key, record=None):
+    if is_flat_key(pdf_key):
+        return pdf_key[len(DOCUMENTS_PREFIX):-len(".pdf")]
+    return record["file_name"] if record else document_id(pdf_key)
+
+# Function to get the label shown for a document in lists. Documents with IDs
+# can share a name, so the start of the ID is added.
+def document_label(pdf_key, record=None):
+    if is_flat_key(pdf_key):
+        return document_name(pdf_key)
+    return f"{document_name(pdf_key, record)} ({document_id(pdf_key)[:8]})"
+
+# Function to send a PDF to S3. Large files go through a resumable multipart
+# upload; small ones are a single request using the tuned transfer settings.
+def upload_pdf(file, bucket_name, object_name, callback=None, metadata=None):
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if size >= TRANSFER_CONFIG.multipart_threshold:
+        upload_multipart_resumable(file, bucket_name, object_name, size, callback, metadata)
+    else:
+        s3.upload_fileobj(
+            file,
+            bucket_name,
+            object_name,
+            ExtraArgs={"ContentType": "application/pdf", "Metadata": metadata or {}},
+            Config=TRANSFER_CONFIG,
+            Callback=callback
+        )
+
+# Function to compute the SHA-256 of a file without reading it all into memory
+def sha256_of(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(MB), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+# Function to hold the lock guarding reads and writes of the upload state
+# file. It is shared by every session and rerun, like the other shared state.
+@st.cache_resource
+def get_upload_state_lock():
+    return threading.Lock()
+
+def load_upload_state():
+    try:
+        with open(UPLOAD_STATE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+# Function to apply a change to the upload state file; the change function
+# receives the whole state dict and edits it in place
+def update_upload_state(change):
+    with get_upload_state_lock():
+        state = load_upload_state()
+        change(state)
+        # A temp file of its own, so another process's write cannot move it
+        handle, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(UPLOAD_STATE_FILE)), suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_file, UPLOAD_STATE_FILE)
+
+# Function to upload a large file in parts, recording the upload ID and every
+# finished part so that a later attempt at the same key only sends the parts
+# that are missing. Parts recorded earlier are reused only if their ETag still
+# matches the MD5 of the local bytes, so a different file is never stitched in.
+def upload_multipart_resumable(file, bucket_name, object_name, size, callback=None, metadata=None):
+    # S3 allows at most 10,000 parts per upload
+    part_size = max(TRANSFER_CONFIG.multipart_chunksize, -(-size // 10000))
+    part_count = -(-size // part_size)
+    state_key = f"{bucket_name}/{object_name}"
+
+    # Look for an earlier attempt at this key that is still open on S3
+    entry = load_upload_state().get(state_key)
+    if entry is not None:
+        if entry["size"] != size or entry["part_size"] != part_size:
+            entry = None
+        else:
+            try:
+                s3.list_parts(Bucket=bucket_name, Key=object_name, UploadId=entry["upload_id"], MaxParts=1)
+            except ClientError:
+                # Completed or aborted since it was recorded
+                entry = None
+
+    if entry is None:
+        response = s3.create_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_name,
+            ContentType="application/pdf",
+            Metadata=metadata or {}
+        )
+        entry = {"upload_id": response["UploadId"], "size": size, "part_size": part_size, "parts": {}}
+        update_upload_state(lambda state: state.update({state_key: entry}))
+
+    upload_id = entry["upload_id"]
+    recorded_parts = entry["parts"]
+    read_lock = threading.Lock()
+
+    def record_part(part_number, etag):
+        def change(state):
+            if state_key in state:
+                state[state_key]["parts"][str(part_number)] = etag
+        update_upload_state(change)
+
+    def send_part(part_number):
+        with read_lock:
+            file.seek((part_number - 1) * part_size)
+            data = file.read(part_size)
+        etag = recorded_parts.get(str(part_number))
+        if etag is None or etag.strip('"') != hashlib.md5(data).hexdigest():
+            response = s3.upload_part(
+                Bucket=bucket_name,
+                Key=object_name,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data
+            )
+            etag = response["ETag"]
+            record_part(part_number, etag)
+        if callback:
+            callback(len(data))
+        return {"PartNumber": part_number, "ETag": etag}
+
+    with ThreadPoolExecutor(max_workers=TRANSFER_CONFIG.max_concurrency) as pool:
+        parts = list(pool.map(send_part, range(1, part_count + 1)))
+
+    s3.complete_multipart_upload(
+        Bucket=bucket_name,
+        Key=object_name,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts}
+    )
+    update_upload_state(lambda state: state.pop(state_key, None))
+
+# Function to abort multipart uploads under a prefix that were started more
+# than the given number of hours ago. Returns the keys that were aborted.
+def abort_stale_uploads(bucket_name, prefix, older_than_hours):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=older_than_hours)
+    aborted = []
+    paginator = s3.get_paginator("list_multipart_uploads")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for upload in page.get("Uploads", []):
+            if upload["Initiated"] < cutoff:
+                s3.abort_multipart_upload(Bucket=bucket_name, Key=upload["Key"], UploadId=upload["UploadId"])
+                aborted.append(upload["Key"])
+
+    # Forget the recorded state of anything that was aborted
+    def change(state):
+        for key in aborted:
+            state.pop(f"{bucket_name}/{key}", None)
+    if aborted:
+        update_upload_state(change)
+    return aborted
+
+# Function to hold the selected files that are kept in memory by all sessions.
+# They are held weakly, so files of sessions that have ended drop out on their own.
+@st.cache_resource
+def get_upload_buffers():
+    return weakref.WeakSet()
+
+# Function to count the bytes of selected files held in memory right now
+def upload_memory_in_use():
+    return sum(file.size for file in list(get_upload_buffers()) if not file.closed)
+
+# Path of a spooled file. Paths are plain strings, which cannot be held weakly.
+class SpooledPath(str):
+    pass
+
+# Function to hold the paths of spooled files staged by all sessions, weakly
+# like the in-memory buffers, so files of sessions that have ended drop out
+@st.cache_resource
+def get_spooled_paths():
+    return weakref.WeakSet()
+
+# Function to copy a file to the spool directory in chunks, returning its path.
+# Spooled files older than STALE_UPLOAD_HOURS that no live session has staged,
+# e.g. left behind by a server that stopped, are removed on the way.
+def spool_to_disk(file):
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    cutoff = time.time() - STALE_UPLOAD_HOURS * 3600
+    staged = {os.path.abspath(path) for path in list(get_spooled_paths())}
+    for entry in os.scandir(UPLOAD_SPOOL_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff and os.path.abspath(entry.path) not in staged:
+            os.remove(entry.path)
+
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, suffix=".pdf", delete=False) as spooled:
+        file.seek(0)
+        shutil.copyfileobj(file, spooled, MB)
+    path = SpooledPath(spooled.name)
+    get_spooled_paths().add(path)
+    return path
+
+# Function to move newly selected files out of the file uploader into the
+# session's list of files waiting to be uploaded. Streamlit's own copy of each
+# file is dropped; large files, and files that would take the memory in use
+# over the budget, are spooled to disk and their in-memory copy closed.
+def stage_uploads(uploaded_files):
+    staged = st.session_state.setdefault("staged_uploads", [])
+    buffers = get_upload_buffers()
+    ctx = get_script_run_ctx()
+    # Only Streamlit's in-memory file manager can drop single files
+    remove_file = getattr(ctx.uploaded_file_mgr, "remove_file", None) if ctx else None
+
+    for uploaded_file in uploaded_files:
+        entry = {
+            "file_id": uploaded_file.file_id,
+            "name": uploaded_file.name,
+            "size": uploaded_file.size,
+            "file": None,
+            "path": None,
+            # Kept across retries, so a failed upload is retried under the same key
+            "doc_id": uuid.uuid4().hex,
+        }
+        if (uploaded_file.size >= UPLOAD_SPOOL_THRESHOLD
+                or upload_memory_in_use() + uploaded_file.size > UPLOAD_MEMORY_BUDGET):
+            entry["path"] = spool_to_disk(uploaded_file)
+            uploaded_file.close()
+        else:
+            entry["file"] = uploaded_file
+            buffers.add(uploaded_file)
+        if remove_file:
+            remove_file(ctx.session_id, uploaded_file.file_id)
+        staged.append(entry)
+
+# Function to free the memory or disk space held by a staged file
+def release_staged_upload(entry):
+    if entry["file"] is not None:
+        entry["file"].close()
+    if entry["path"] is not None:
+        try:
+            os.remove(entry["path"])
+        except FileNotFoundError:
+            pass
+
+# Callback for "Clear Files"
+def clear_staged_uploads():
+    for entry in st.session_state.get("staged_uploads", []):
+        release_staged_upload(entry)
+    st.session_state.staged_uploads = []
+
+# Function to list every PDF in the bucket, walking all pages of results.
+# The result is shared across sessions and reruns until the TTL expires or
+# one of our own uploads, edits or deletes invalidates it.
+@st.cache_data(ttl=CATALOG_TTL_SECONDS, show_spinner="Loading file list...")
+def list_documents(bucket_name, prefix):
+    return list_pdf_keys(bucket_name, prefix)
+
+# Function to list every PDF key under a prefix straight from S3, sorted. The
+# sizes in the listing are remembered for the catalog statistics.
+def list_pdf_keys(bucket_name, prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    files = []
+    sizes = {}
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".pdf"):
+                files.append(obj["Key"])
+                sizes[obj["Key"]] = obj["Size"]
+    remember_document_sizes(sizes)
+    return sorted(files)
+
+# Function to hold the size of every PDF seen in a listing or uploaded from
+# this server, so changes can be counted in the statistics without asking S3
+@st.cache_resource
+def get_document_sizes():
+    return {"lock": threading.Lock(), "sizes": {}}
+
+# Function to record PDF sizes; a size of None forgets the PDF
+def remember_document_sizes(sizes):
+    document_sizes = get_document_sizes()
+    with document_sizes["lock"]:
+        for pdf_key, size in sizes.items():
+            if size is None:
+                document_sizes["sizes"].pop(pdf_key, None)
+            else:
+                document_sizes["sizes"][pdf_key] = size
+
+# Function to look up the sizes of PDFs, asking S3 for those not seen yet.
+# Sizes that cannot be found are None.
+def document_sizes(pdf_keys):
+    cache = get_document_sizes()
+    with cache["lock"]:
+        sizes = {pdf_key: cache["sizes"].get(pdf_key) for pdf_key in pdf_keys}
+    for pdf_key, size in sizes.items():
+        if size is None:
+            try:
+                sizes[pdf_key] = s3.head_object(Bucket=BUCKET_NAME, Key=pdf_key)["ContentLength"]
+            except ClientError:
+                continue
+    remember_document_sizes({pdf_key: size for pdf_key, size in sizes.items() if size is not None})
+    return sizes
+
+# Function to drop the cached file list after the bucket changes
+def invalidate_catalog():
+    list_documents.clear()
+
+# Function to get the process pool for text extraction, shared by every
+# session. Processes are spawned rather than forked, since forking a server
+# with many threads can copy locks that are held.
+@st.cache_resource
+def get_extraction_pool():
+    return ProcessPoolExecutor(
+        max_workers=EXTRACTION_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+# Function to get the key of the extracted-text sidecar of a PDF
+def sidecar_key(pdf_key):
+    return pdf_key[:-len(".pdf")] + SIDECAR_SUFFIX
+
+# Function to store the result of a text extraction next to its PDF
+def put_sidecar(pdf_key, extraction, content_hash=None):
+    body = json.dumps({
+        **extraction,
+        "sha256": content_hash,
+        "extracted_at": datetime.now(timezone.utc).isoformat(),
+    }).encode("utf-8")
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=sidecar_key(pdf_key),
+        Body=gzip.compress(body),
+        ContentType="application/gzip"
+    )
+
+# Function to get the key of a PDF's thumbnail, under the thumbnail prefix
+def thumbnail_key(pdf_key):
+    return THUMBNAILS_PREFIX + pdf_key[len(DOCUMENTS_PREFIX):-len(".pdf")] + ".jpg"
+
+# Function to hold the thumbnails shown recently, shared by every session.
+# Entries map a PDF key to the JPEG bytes, or to None for documents that have
+# no thumbnail, least recently used first.
+@st.cache_resource
+def get_thumbnail_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "bytes": 0}
+
+# Function to remember a thumbnail, evicting the least recently used ones
+# while the cache holds more than THUMBNAIL_CACHE_BYTES
+def cache_thumbnail(pdf_key, thumbnail):
+    cache = get_thumbnail_cache()
+    with cache["lock"]:
+        old = cache["entries"].pop(pdf_key, None)
+        cache["bytes"] -= len(old or b"")
+        cache["entries"][pdf_key] = thumbnail
+        cache["bytes"] += len(thumbnail or b"")
+        while cache["bytes"] > THUMBNAIL_CACHE_BYTES and len(cache["entries"]) > 1:
+            _, evicted = cache["entries"].popitem(last=False)
+            cache["bytes"] -= len(evicted or b"")
+
+def forget_thumbnails(pdf_keys):
+    cache = get_thumbnail_cache()
+    with cache["lock"]:
+        for pdf_key in pdf_keys:
+            cache["bytes"] -= len(cache["entries"].pop(pdf_key, None) or b"")
+
+# Function to store a thumbnail under the thumbnail prefix and in the cache
+def put_thumbnail(pdf_key, thumbnail):
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=thumbnail_key(pdf_key),
+        Body=thumbnail,
+        ContentType="image/jpeg"
+    )
+    cache_thumbnail(pdf_key, thumbnail)
+
+# Function to draw the thumbnail of a stored PDF that has none. Only the start
+# of the PDF is read at first, with a ranged GET; see THUMBNAIL_RANGE_BYTES.
+# Returns None when more than max_source_bytes would have to be read.
+def make_thumbnail(pdf_key, max_source_bytes=THUMBNAIL_MAX_SOURCE_BYTES):
+    response = s3.get_object(Bucket=BUCKET_NAME, Key=pdf_key, Range=f"bytes=0-{THUMBNAIL_RANGE_BYTES - 1}")
+    data = response["Body"].read()
+    size = int(response.get("ContentRange", "/0").rsplit("/", 1)[1] or len(data))
+    if len(data) < size:
+        first_page = first_page_end(data)
+        if first_page is not None and first_page <= max_source_bytes:
+            end = min(first_page, size)
+        elif size <= max_source_bytes:
+            end = size
+        else:
+            return None
+        if end > len(data):
+            response = s3.get_object(Bucket=BUCKET_NAME, Key=pdf_key, Range=f"bytes={len(data)}-{end - 1}")
+            data += response["Body"].read()
+
+    try:
+        thumbnail = get_extraction_pool().submit(render_thumbnail, data, THUMBNAIL_WIDTH).result()
+    except BrokenProcessPool:
+        get_extraction_pool.clear()
+        raise
+    put_thumbnail(pdf_key, thumbnail)
+    return thumbnail
+
+# Function to get a document's thumbnail: from memory, else from the
+# thumbnail prefix, else drawn now from at most max_source_bytes of the PDF.
+# Returns None for documents that cannot have one; those are not tried again
+# until they leave the cache. Safe to call from worker threads.
+def get_thumbnail(pdf_key, max_source_bytes=THUMBNAIL_MAX_SOURCE_BYTES):
+    cache = get_thumbnail_cache()
+    with cache["lock"]:
+        if pdf_key in cache["entries"]:
+            cache["entries"].move_to_end(pdf_key)
+            return cache["entries"][pdf_key]
+
+    try:
+        thumbnail = s3.get_object(Bucket=BUCKET_NAME, Key=thumbnail_key(pdf_key))["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        thumbnail = None
+        if THUMBNAILS_ENABLED:
+            try:
+                thumbnail = make_thumbnail(pdf_key, max_source_bytes)
+            except Exception:
+                pass  # Damaged or unusual PDFs are shown without a preview
+            else:
+                if thumbnail is None and max_source_bytes < THUMBNAIL_MAX_SOURCE_BYTES:
+                    return None  # Not remembered, so a larger limit can still draw it
+    cache_thumbnail(pdf_key, thumbnail)
+    return thumbnail
+
+# Function to get the thumbnails of several documents in parallel, through the
+# shared rate controller and reading at most THUMBNAIL_GRID_SOURCE_BYTES of
+# each PDF. Returns PDF key -> thumbnail or None; errors reading one are shown
+# as no thumbnail.
+def get_thumbnails(pdf_keys):
+    def fetch(pdf_key):
+        try:
+            return run_throttled(get_thumbnail, pdf_key, THUMBNAIL_GRID_SOURCE_BYTES)
+        except Exception:
+            return None
+    with ThreadPoolExecutor(max_workers=METADATA_PREFETCH_WORKERS) as pool:
+        return dict(zip(pdf_keys, pool.map(fetch, pdf_keys)))
+
+# Function to upload one PDF and its metadata CSV. This runs on worker threads,
+# so it must not call st.* functions; errors are raised to the caller instead.
+# The PDF key defaults to a new key in the configured layout. Given
+# extract_source (the PDF's bytes or a path to it), the text is extracted in
+# the process pool while the PDF uploads and stored as a sidecar. Returns the
+# error of that stage if it failed; the document itself is uploaded either way.
+# Given thumbnail_source, a thumbnail is drawn the same way; if that fails, it
+# is drawn when the document is first previewed instead.
+def upload_document(file, new_name, departments, semesters, tags, callback=None, content_hash=None, skip_pdf=False,
+                    extract_source=None, pdf_key=None, thumbnail_source=None):
+    pdf_key = pdf_key or new_document_key(new_name, departments)
+    extraction = None
+    if extract_source is not None:
+        extraction = get_extraction_pool().submit(extract_pdf_info, extract_source)
+    thumbnail = None
+    if thumbnail_source is not None and not skip_pdf:
+        thumbnail = get_extraction_pool().submit(render_thumbnail, thumbnail_source, THUMBNAIL_WIDTH)
+
+    if not skip_pdf:
+        metadata = {"sha256": content_hash} if content_hash else None
+        upload_pdf(file, BUCKET_NAME, pdf_key, callback, metadata)
+        forget_thumbnails([pdf_key])  # An older file may have had this key
+    put_metadata_csv(pdf_key, metadata_record(new_name, departments, semesters, tags))
+
+    if thumbnail is not None:
+        try:
+            with_retries(put_thumbnail, pdf_key, thumbnail.result())
+        except BrokenProcessPool:
+            get_extraction_pool.clear()
+        except Exception:
+            pass
+
+    if extraction is None:
+        return None
+    try:
+        with_retries(put_sidecar, pdf_key, extraction.result(), content_hash)
+    except BrokenProcessPool as e:
+        get_extraction_pool.clear()  # A worker died; start a fresh pool next time
+        return e
+    except Exception as e:
+        return e
+    return None
+
+# Function to upload a batch of documents on a thread pool while showing a
+# progress bar per file and one for the whole batch. Each file is hashed first;
+# with skip_duplicates, files whose bytes are already stored under another key
+# (or earlier in the same batch) are not uploaded. Jobs give the PDF "key" to
+# store under and either an open "file" or the "path" of a spooled one. With
+# extract, text is extracted from each uploaded file and failures of that
+# stage are stored in the job's "extract_error". on_done is called with a
+# job's index, from this thread, as soon as that job has finished without an
+# error. Returns a list of (file name, error, duplicate of, content hash)
+# tuples in job order; error is None when the upload worked and "duplicate of"
+# is the existing PDF key for skipped files.
+def upload_documents(jobs, max_workers, known_hashes=None, skip_duplicates=True, on_done=None, extract=False):
+    total_bytes = sum(job["size"] for job in jobs) or 1
+    sent = [0] * len(jobs)  # Bytes sent per file, updated by the workers
+    lock = threading.Lock()
+    claimed_hashes = dict(known_hashes or {})  # Hash -> PDF key, shared by the workers
+
+    def make_callback(i):
+        def callback(bytes_sent):
+            with lock:
+                sent[i] += bytes_sent
+        return callback
+
+    def process(i, job):
+        # Spooled files are opened by the worker, so only files in flight hold a handle
+        if job.get("path"):
+            with open(job["path"], "rb") as file:
+                return process_file(i, job, file)
+        return process_file(i, job, job["file"])
+
+    def process_file(i, job, file):
+        with lock:
+            sent[i] = 0  # Progress starts over when throttled work is retried
+        pdf_key = job["key"]
+        content_hash = sha256_of(file)
+        with lock:
+            duplicate_of = claimed_hashes.setdefault(content_hash, pdf_key)
+        if duplicate_of == pdf_key:
+            duplicate_of = None
+        elif skip_duplicates:
+            return duplicate_of, content_hash
+
+        # Re-uploading identical bytes to the same key only needs fresh metadata
+        same_file = (known_hashes or {}).get(content_hash) == pdf_key
+        job["extract_error"] = upload_document(
+            file,
+            job["name"],
+            job["departments"],
+            job["semesters"],
+            job["tags"],
+            make_callback(i),
+            content_hash=content_hash,
+            skip_pdf=same_file,
+            extract_source=(job.get("path") or file.getvalue()) if extract else None,
+            pdf_key=pdf_key,
+            thumbnail_source=(job.get("path") or file.getvalue()) if THUMBNAILS_ENABLED else None
+        )
+        return duplicate_of, content_hash
+
+    batch_bar = st.progress(0.0, text=f"0 of {len(jobs)} files done")
+    file_bars = [st.progress(0.0, text=f"{job['name']}.pdf") for job in jobs]
+    results = [None] * len(jobs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for i, job in enumerate(jobs):
+            futures[pool.submit(run_throttled, process, i, job)] = i
+
+        # Redraw the progress bars from this thread until every upload is done
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.25)
+            for future in done:
+                i = futures[future]
+                error = future.exception()
+                duplicate_of, content_hash = (None, None) if error else future.result()
+                results[i] = (jobs[i]["name"], error, duplicate_of, content_hash)
+                if error is None and on_done:
+                    on_done(i)
+
+            with lock:
+                sent_now = list(sent)
+            for i, job in enumerate(jobs):
+                fraction = min(sent_now[i] / (job["size"] or 1), 1.0)
+                if results[i] is None:
+                    file_bars[i].progress(fraction, text=f"{job['name']}.pdf ({fraction:.0%})")
+                elif results[i][1] is None and results[i][2] and skip_duplicates:
+                    file_bars[i].progress(1.0, text=f"{job['name']}.pdf (duplicate, skipped)")
+                elif results[i][1] is None:
+                    file_bars[i].progress(1.0, text=f"{job['name']}.pdf (done)")
+                else:
+                    file_bars[i].progress(fraction, text=f"{job['name']}.pdf (failed)")
+
+            finished = len(jobs) - len(pending)
+            batch_bar.progress(
+                min(sum(sent_now) / total_bytes, 1.0),
+                text=f"{finished} of {len(jobs)} files done"
+            )
+
+    return results
+
+def generate_metadata_csv(file_name, departments, semesters, tags):
+    # Replace "All" with the full list of values
+    if "All" in departments:
+        departments = DEPARTMENTS
+    if "All" in semesters:
+        semesters = SEMESTERS
+    
+    # Create a CSV string with headers and data
+    csv_output = StringIO()
+    writer = csv.writer(csv_output)
+    
+    # Write headers
+    writer.writerow(["file_name", "departments", "semesters", "tags"])
+    
+    # Write data
+    writer.writerow([
+        file_name,                     # file_name
+        ",".join(departments),         # departments
+        ",".join(semesters),           # semesters
+        ",".join(tags)                 # tags
+    ])
+    
+    # Return the CSV string
+    return csv_output.getvalue()
+
+# Function to prepare a batch of direct uploads. Each slot is a new key with an
+# ID, also when KEY_LAYOUT is flat, since the file names are not known yet,
+# and a presigned POST that only accepts a PDF of at most
+# DIRECT_UPLOAD_MAX_BYTES at that key. The browser sends each file's name
+# along as object metadata.
+def presign_direct_uploads(count, departments):
+    layout = "hash" if KEY_LAYOUT == "flat" else KEY_LAYOUT
+    slots = []
+    for _ in range(count):
+        pdf_key = new_document_key(None, departments, layout)
+        post = s3.generate_presigned_post(
+            Bucket=BUCKET_NAME,
+            Key=pdf_key,
+            Fields={"Content-Type": "application/pdf"},
+            Conditions=[
+                {"Content-Type": "application/pdf"},
+                ["content-length-range", 1, DIRECT_UPLOAD_MAX_BYTES],
+                ["starts-with", "$x-amz-meta-filename", ""],
+            ],
+            ExpiresIn=DIRECT_UPLOAD_EXPIRY_SECONDS
+        )
+        slots.append({"key": pdf_key, "url": post["url"], "fields": post["fields"]})
+    return slots
+
+# Function to build the form that sends files from the browser to a batch's
+# slots, UPLOAD_WORKERS at a time. Every file takes the next unused slot. The
+# HTML stays the same for the whole batch, so reruns do not reload the form
+# and cut off uploads in progress; the used slots are kept in the browser's
+# session storage under the batch ID, so a form drawn anew never reuses one.
+def direct_upload_html(batch_id, slots):
+    slots_json = json.dumps(
+        [{"url": slot["url"], "fields": slot["fields"]} for slot in slots]
+    ).replace("</", "<\\/")
+    return f"""
+<div style="font-family: sans-serif; font-size: 14px;">
+  <input type="file" id="files" accept="application/pdf,.pdf" multiple>
+  <button id="send">Send to S3</button>
+  <ul id="status"></ul>
+</div>
+<script>
+const slots = {slots_json};
+const storageKey = "direct-upload-{batch_id}";
+let used = [];
+try {{
+  used = JSON.parse(sessionStorage.getItem(storageKey) || "[]");
+}} catch (error) {{}}
+const claimSlot = () => {{
+  const index = slots.findIndex((slot, i) => !used.includes(i));
+  used.push(index);
+  try {{
+    sessionStorage.setItem(storageKey, JSON.stringify(used));
+  }} catch (error) {{}}
+  return slots[index];
+}};
+document.getElementById("send").onclick = () => {{
+  const files = Array.from(document.getElementById("files").files);
+  const status = document.getElementById("status");
+  if (files.length > slots.length - used.length) {{
+    status.textContent = `Only ${{slots.length - used.length}} more file(s) can be sent in this batch.`;
+    return;
+  }}
+  status.textContent = "";
+  const jobs = files.map(file => {{
+    const line = document.createElement("li");
+    line.textContent = `${{file.name}}: waiting`;
+    status.appendChild(line);
+    return {{file, line, slot: claimSlot()}};
+  }});
+  const sendNext = () => {{
+    const job = jobs.shift();
+    if (!job) return;
+    const form = new FormData();
+    for (const [name, value] of Object.entries(job.slot.fields)) form.append(name, value);
+    form.append("x-amz-meta-filename", encodeURIComponent(job.file.name));
+    form.append("file", job.file);  // S3 ignores fields after the file
+    const request = new XMLHttpRequest();
+    request.open("POST", job.slot.url);
+    request.upload.onprogress = event => {{
+      job.line.textContent = `${{job.file.name}}: ${{Math.round(100 * event.loaded / event.total)}}%`;
+    }};
+    request.onload = () => {{
+      job.line.textContent = `${{job.file.name}}: ` + (request.status < 300 ? "sent" : `failed (${{request.status}})`);
+      sendNext();
+    }};
+    request.onerror = () => {{
+      job.line.textContent = `${{job.file.name}}: failed`;
+      sendNext();
+    }};
+    request.send(form);
+  }};
+  for (let i = 0; i < {UPLOAD_WORKERS}; i++) sendNext();
+}};
+</script>
+"""
+
+# Function to check what has arrived at a direct upload's key. Returns None
+# while nothing has, else (size, file name). The POST policy only fixes the
+# declared content type, so the first bytes are read too, and anything that
+# is not a PDF is removed again.
+def check_direct_upload(pdf_key):
+    try:
+        head = s3.head_object(Bucket=BUCKET_NAME, Key=pdf_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    file_name = unquote(head.get("Metadata", {}).get("filename", ""))
+    file_name = re.sub(r"\.pdf$", "", file_name, flags=re.IGNORECASE) or document_id(pdf_key)
+    start = s3.get_object(Bucket=BUCKET_NAME, Key=pdf_key, Range="bytes=0-4")["Body"].read()
+    if start != b"%PDF-":
+        s3.delete_object(Bucket=BUCKET_NAME, Key=pdf_key)
+        raise ValueError(f"{file_name} is not a PDF and was removed")
+    return head["ContentLength"], file_name
+
+# Function to delete PDFs together with their metadata CSVs, extracted text
+# and thumbnails using batched DeleteObjects requests. Each PDF is sent in the
+# same batch as the rest of its objects.
+# Returns (deleted PDF keys, list of (key, error message) for failed keys).
+def delete_documents(pdf_keys):
+    keys = []
+    for pdf_key in pdf_keys:
+        keys.append(pdf_key)
+        keys.append(metadata_key(pdf_key))
+        keys.append(sidecar_key(pdf_key))
+        keys.append(thumbnail_key(pdf_key))
+
+    errors = []
+    # Batches hold whole documents, 4 keys each
+    batch_size = DELETE_BATCH_SIZE - DELETE_BATCH_SIZE % 4
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        # S3 can throttle single keys inside a successful response; those are
+        # sent again after a backoff
+        for attempt in range(S3_TASK_ATTEMPTS):
+            try:
+                response = with_retries(
+                    s3.delete_objects,
+                    Bucket=BUCKET_NAME,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                )
+            except Exception as e:
+                errors.extend((key, str(e)) for key in batch)
+                break
+            throttled = []
+            for error in response.get("Errors", []):
+                if error["Code"] in THROTTLING_CODES and attempt < S3_TASK_ATTEMPTS - 1:
+                    throttled.append(error["Key"])
+                else:
+                    errors.append((error["Key"], f"{error['Code']}: {error['Message']}"))
+            if not throttled:
+                break
+            batch = throttled
+            backoff(attempt)
+
+    failed_keys = {key for key, _ in errors}
+    deleted = [pdf_key for pdf_key in pdf_keys if pdf_key not in failed_keys]
+    forget_metadata(deleted)
+    forget_thumbnails(deleted)
+    return deleted, errors
+
+# Callback for the bulk delete button. It runs before the page is redrawn, so
+# the selection widgets can be reset and the summary shown on the next run.
+def bulk_delete(pdf_keys):
+    before = previous_metadata(pdf_keys)
+    deleted, errors = delete_documents(pdf_keys)
+    finish_deletes(deleted, before)
+    st.session_state.bulk_delete_result = (deleted, errors)
+    st.session_state.bulk_delete_files = []
+    st.session_state.bulk_delete_all = False
+    st.session_state.bulk_delete_confirm = False
+
+# Function to copy a document to a new PDF key inside S3: the PDF server-side
+# (a multipart copy above 5 GB), a CSV with the given metadata record, and the
+# extracted text if there is any. The copy is checked against the original; on
+# any failure whatever was copied is removed again and the error raised. The
+# original is never touched. Safe to call from worker threads.
+def copy_document(old_pdf_key, new_pdf_key, record):
+    new_csv_key = metadata_key(new_pdf_key)
+    source = s3.head_object(Bucket=BUCKET_NAME, Key=old_pdf_key)
+    copy_source = {"Bucket": BUCKET_NAME, "Key": old_pdf_key}
+    try:
+        if source["ContentLength"] <= MAX_COPY_OBJECT_SIZE:
+            s3.copy_object(
+                Bucket=BUCKET_NAME,
+                Key=new_pdf_key,
+                CopySource=copy_source,
+                MetadataDirective="COPY"
+            )
+        else:
+            s3.copy(
+                copy_source,
+                BUCKET_NAME,
+                new_pdf_key,
+                ExtraArgs={"ContentType": source.get("ContentType", "application/pdf"), "Metadata": source.get("Metadata", {})},
+                Config=TRANSFER_CONFIG
+            )
+        put_metadata_csv(new_pdf_key, record)
+
+        # Move the extracted text and the thumbnail along, if the document has them
+        for derived_key in (sidecar_key, thumbnail_key):
+            try:
+                s3.copy_object(
+                    Bucket=BUCKET_NAME,
+                    Key=derived_key(new_pdf_key),
+                    CopySource={"Bucket": BUCKET_NAME, "Key": derived_key(old_pdf_key)}
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                    raise
+
+        # Check the copy against the original
+        copy = s3.head_object(Bucket=BUCKET_NAME, Key=new_pdf_key)
+        if copy["ContentLength"] != source["ContentLength"]:
+            raise RuntimeError(f"copy of {old_pdf_key} has the wrong size")
+        if source.get("Metadata", {}).get("sha256") != copy.get("Metadata", {}).get("sha256"):
+            raise RuntimeError(f"copy of {old_pdf_key} has a different content hash")
+        s3.head_object(Bucket=BUCKET_NAME, Key=new_csv_key)
+    except Exception:
+        # Leave the original untouched and clean up whatever was copied
+        s3.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={
+                "Objects": [
+                    {"Key": new_pdf_key},
+                    {"Key": new_csv_key},
+                    {"Key": sidecar_key(new_pdf_key)},
+                    {"Key": thumbnail_key(new_pdf_key)},
+                ],
+                "Quiet": True
+            }
+        )
+        raise
+
+# Function to rename a document. Documents with IDs keep their keys and only
+# get a new CSV. Flat documents move to the key of their new name; the copy is
+# checked before the old PDF and CSV are deleted, so a failure never loses the
+# original. The metadata record defaults to the one in the old CSV. This runs
+# on worker threads for bulk renames, so it must not call st.* functions.
+# Returns (new PDF key, new metadata record).
+def rename_document(old_pdf_key, new_name, record=None):
+    check_document_name(new_name)
+    if not is_flat_key(old_pdf_key):
+        record = {**(record or get_metadata(old_pdf_key)), "file_name": new_name}
+        put_metadata_csv(old_pdf_key, record)
+        return old_pdf_key, record
+
+    new_pdf_key = new_document_key(new_name, [], layout="flat")
+    if new_pdf_key == old_pdf_key:
+        raise ValueError("the new name is the same as the old one")
+    if object_exists(new_pdf_key):
+        raise ValueError(f"{new_pdf_key} already exists")
+
+    if record is None:
+        record = get_metadata(old_pdf_key)
+    record = {**record, "file_name": new_name}
+    copy_document(old_pdf_key, new_pdf_key, record)
+
+    _, errors = delete_documents([old_pdf_key])
+    if errors:
+        raise RuntimeError("renamed, but the old file could not be removed: " +
+                           "; ".join(f"{key}: {error}" for key, error in errors))
+    return new_pdf_key, record
+
+# Function to get the SHA-256 stored with a PDF when it was uploaded, or None
+def stored_content_hash(pdf_key):
+    try:
+        return s3.head_object(Bucket=BUCKET_NAME, Key=pdf_key).get("Metadata", {}).get("sha256")
+    except ClientError:
+        return None
+
+# Function to check whether an object exists
+def object_exists(key):
+    try:
+        s3.head_object(Bucket=BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+# Function to rename many documents on a thread pool. Renames maps old PDF
+# keys to new names. Returns (list of (old key, new key, record), list of
+# (old key, error)).
+def rename_documents(renames, max_workers):
+    renamed = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(run_throttled, rename_document, old_key, new_name): old_key
+            for old_key, new_name in renames.items()
+        }
+        for future in futures:
+            old_key = futures[future]
+            try:
+                new_key, record = future.result()
+                renamed.append((old_key, new_key, record))
+            except Exception as e:
+                errors.append((old_key, e))
+    return renamed, errors
+
+# Function to update the caches and indexes after documents were renamed.
+# Before maps the old keys to their metadata from before the renames.
+def finish_renames(renamed, before):
+    if not renamed:
+        return
+    invalidate_catalog()
+    changes = {}
+    for old_key, new_key, record in renamed:
+        changes[old_key] = None
+        changes[new_key] = record
+    apply_metadata_changes(changes)
+
+    new_keys = {old_key: new_key for old_key, new_key, _ in renamed}
+    hashes = {}
+    def change(index):
+        for content_hash, key in index.items():
+            if key in new_keys:
+                index[content_hash] = new_keys[key]
+                hashes[key] = content_hash
+    sync_hash_index(change)
+
+    sizes = document_sizes(list(new_keys))
+    remember_document_sizes({old_key: None for old_key in new_keys if new_keys[old_key] != old_key})
+    remember_document_sizes({new_keys[old_key]: size for old_key, size in sizes.items() if size is not None})
+    log_changes([
+        change_record(
+            "rename", new_key, hashes.get(old_key), before.get(old_key), record,
+            previous_key=old_key, size=sizes[old_key]
+        )
+        for old_key, new_key, record in renamed
+    ])
+
+# Function to update the caches and indexes after documents were deleted.
+# Before maps their keys to their metadata from before the deletes.
+def finish_deletes(deleted, before):
+    if not deleted:
+        return
+    invalidate_catalog()
+    apply_metadata_changes({pdf_key: None for pdf_key in deleted})
+    hashes = forget_content_hashes(deleted)
+    # Sizes were remembered when the documents were listed or uploaded
+    sizes = document_sizes(deleted)
+    remember_document_sizes({pdf_key: None for pdf_key in deleted})
+    log_changes([
+        change_record("delete", pdf_key, hashes.get(pdf_key), before.get(pdf_key), None, size=sizes[pdf_key])
+        for pdf_key in deleted
+    ])
+
+# Callback for the file picker on the edit page. The form widgets keep their
+# values between reruns, so they are cleared to show the newly picked file's
+# name and metadata instead of the previous file's (which a save would then
+# apply to the wrong file).
+def reset_edit_form():
+    for key in ("edit_name", "edit_dept", "edit_sem", "edit_tags"):
+        st.session_state.pop(key, None)
+
+# Callback for the "Edit" buttons under the previews: picks that document in
+# the file picker
+def pick_document(pdf_key):
+    st.session_state.edit_selection = pdf_key
+    reset_edit_form()
+
+# Callback for the bulk rename button, run before the page is redrawn
+def bulk_rename(renames, max_workers):
+    before = previous_metadata(list(renames))
+    renamed, errors = rename_documents(renames, max_workers)
+    finish_renames(renamed, before)
+    st.session_state.bulk_rename_result = (renamed, errors)
+    st.session_state.bulk_rename_find = ""
+    st.session_state.bulk_rename_replace = ""
+
+# Function to apply a bulk edit to a metadata record. Operations map a facet
+# to (action, values), the action being "add", "remove" or "replace". Existing
+# values keep their order and added ones go at the end.
+def edit_record(record, operations):
+    edited = dict(record)
+    for facet, (action, values) in operations.items():
+        current = record[facet]
+        if action == "add":
+            edited[facet] = current + [value for value in values if value not in current]
+        elif action == "remove":
+            edited[facet] = [value for value in current if value not in values]
+        elif action == "replace":
+            edited[facet] = list(values)
+    return edited
+
+# Function to bulk edit one document. Its metadata is read again, as another
+# admin may have changed it since the preview, and the CSV is only written if
+# the edit changes it. Returns (before, after); after is None if unchanged.
+def bulk_edit_document(pdf_key, operations):
+    before = get_metadata(pdf_key)
+    after = edit_record(before, operations)
+    if after == before:
+        return before, None
+    put_metadata_csv(pdf_key, after)
+    return before, after
+
+# Function to bulk edit many documents on a thread pool. Returns (list of
+# (key, before, after) for rewritten CSVs, number left unchanged, list of
+# (key, error)).
+def bulk_edit_documents(pdf_keys, operations, max_workers):
+    edited = []
+    unchanged = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(run_throttled, bulk_edit_document, pdf_key, operations): pdf_key for pdf_key in pdf_keys}
+        for future in futures:
+            pdf_key = futures[future]
+            try:
+                before, after = future.result()
+            except Exception as e:
+                errors.append((pdf_key, e))
+                continue
+            if after is None:
+                unchanged += 1
+            else:
+                edited.append((pdf_key, before, after))
+    return edited, unchanged, errors
+
+# Function to update the caches and indexes after metadata was edited
+def finish_metadata_edits(edited):
+    if not edited:
+        return
+    invalidate_catalog()
+    apply_metadata_changes({pdf_key: after for pdf_key, _, after in edited})
+    # Content hashes for the change feed, from the hash index rather than a
+    # HEAD request per file
+    try:
+        index, _ = read_hash_index()
+        hashes = {key: content_hash for content_hash, key in index.items()}
+    except Exception:
+        hashes = {}
+    sizes = document_sizes([pdf_key for pdf_key, _, _ in edited])
+    log_changes([
+        change_record("update", pdf_key, hashes.get(pdf_key), before, after, size=sizes[pdf_key])
+        for pdf_key, before, after in edited
+    ])
+
+# Callback for the bulk edit button, run before the page is redrawn
+def bulk_edit(pdf_keys, operations, max_workers):
+    edited, unchanged, errors = bulk_edit_documents(pdf_keys, operations, max_workers)
+    finish_metadata_edits(edited)
+    st.session_state.bulk_edit_result = (edited, unchanged, errors)
+    for facet in FACETS:
+        st.session_state[f"bulk_edit_{facet}_action"] = "Keep"
+        st.session_state[f"bulk_edit_{facet}_values"] = []
+
+# Function to hold the metadata cache shared by every session. Entries map a
+# CSV key to {"etag", "record", "checked"}, oldest first.
+@st.cache_resource
+def get_metadata_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "pending": set()}
+
+# Function to remember a CSV's metadata, evicting the least recently used
+# entries when the cache is full
+def store_metadata(csv_key, etag, record):
+    cache = get_metadata_cache()
+    with cache["lock"]:
+        cache["entries"][csv_key] = {"etag": etag, "record": record, "checked": time.monotonic()}
+        cache["entries"].move_to_end(csv_key)
+        while len(cache["entries"]) > METADATA_CACHE_SIZE:
+            cache["entries"].popitem(last=False)
+
+def forget_metadata(pdf_keys):
+    cache = get_metadata_cache()
+    with cache["lock"]:
+        for pdf_key in pdf_keys:
+            cache["entries"].pop(metadata_key(pdf_key), None)
+
+# Function to get a document's metadata record. A cached copy is used directly
+# while fresh; otherwise S3 is asked for the CSV only if its ETag changed.
+# Safe to call from worker threads.
+def get_metadata(pdf_key):
+    csv_key = metadata_key(pdf_key)
+    cache = get_metadata_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(csv_key)
+        if entry is not None:
+            cache["entries"].move_to_end(csv_key)
+            if time.monotonic() - entry["checked"] < METADATA_FRESH_SECONDS:
+                return entry["record"]
+
+    try:
+        if entry is None:
+            response = s3.get_object(Bucket=BUCKET_NAME, Key=csv_key)
+        else:
+            response = s3.get_object(Bucket=BUCKET_NAME, Key=csv_key, IfNoneMatch=entry["etag"])
+    except ClientError as e:
+        if entry is not None and e.response["Error"]["Code"] in ("304", "NotModified"):
+            store_metadata(csv_key, entry["etag"], entry["record"])
+            return entry["record"]
+        raise
+
+    record = parse_metadata_csv(response["Body"].read().decode("utf-8"))
+    store_metadata(csv_key, response["ETag"], record)
+    return record
+
+# Function to write a document's metadata CSV and keep the cache in step
+def put_metadata_csv(pdf_key, record):
+    csv_key = metadata_key(pdf_key)
+    response = s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=csv_key,
+        Body=generate_metadata_csv(record["file_name"], record["departments"], record["semesters"], record["tags"])
+    )
+    store_metadata(csv_key, response["ETag"], record)
+
+# Function to hold the thread pool that fetches metadata in the background
+@st.cache_resource
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=METADATA_PREFETCH_WORKERS)
+
+# Function to start fetching the metadata of documents that are not cached
+# yet, without waiting for the results
+def prefetch_metadata(pdf_keys):
+    cache = get_metadata_cache()
+    with cache["lock"]:
+        missing = [
+            pdf_key for pdf_key in pdf_keys
+            if metadata_key(pdf_key) not in cache["entries"] and pdf_key not in cache["pending"]
+        ]
+        cache["pending"].update(missing)
+
+    def fetch(pdf_key):
+        try:
+            run_throttled(get_metadata, pdf_key)
+        except Exception:
+            pass  # Fetched again, with errors shown, when the file is opened
+        finally:
+            with cache["lock"]:
+                cache["pending"].discard(pdf_key)
+
+    pool = get_prefetch_pool()
+    for pdf_key in missing:
+        pool.submit(fetch, pdf_key)
+
+# Function to turn metadata CSV content back into a metadata record
+def parse_metadata_csv(content):
+    reader = csv.reader(StringIO(content))
+    next(reader)  # Skip headers
+    file_name, departments, semesters, tags = next(reader)
+    return metadata_record(
+        file_name,
+        [d for d in departments.split(",") if d],
+        [s for s in semesters.split(",") if s],
+        [t for t in tags.split(",") if t]
+    )
+
+# Function to build the metadata record stored in the manifest
+def metadata_record(file_name, departments, semesters, tags):
+    # Replace "All" with the full list of values, as in the CSV
+    if "All" in departments:
+        departments = DEPARTMENTS
+    if "All" in semesters:
+        semesters = SEMESTERS
+    return {
+        "file_name": file_name,
+        "departments": list(departments),
+        "semesters": list(semesters),
+        "tags": list(tags),
+    }
+
+# Function to read the manifest. Returns (header, records by PDF key, ETag);
+# the ETag is None when no manifest has been written yet.
+def read_manifest():
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=MANIFEST_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return {"version": MANIFEST_VERSION, "revision": 0}, {}, None
+        raise
+
+    lines = response["Body"].read().decode("utf-8").splitlines()
+    header = json.loads(lines[0])
+    if header.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version {header.get('version')}")
+    records = {}
+    for line in lines[1:]:
+        if line:
+            record = json.loads(line)
+            records[record["key"]] = record
+    return header, records, response["ETag"]
+
+# Function to read the metadata CSVs of many PDFs in parallel. Returns
+# (records by PDF key, list of (PDF key, error) for files that could not be read).
+def fetch_metadata_records(pdf_keys):
+    records = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = {pool.submit(run_throttled, get_metadata, key): key for key in pdf_keys}
+        for future in futures:
+            key = futures[future]
+            try:
+                records[key] = future.result()
+            except Exception as e:
+                errors.append((key, e))
+    return records, errors
+
+# Function to tell whether a conditional write failed because another admin
+# changed the object after we read it
+def is_write_conflict(error):
+    return error.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict")
+
+# Function to write the manifest, but only if nobody changed it since it was
+# read (or, for a new manifest, if nobody created it in the meantime)
+def write_manifest(header, records, etag):
+    lines = [json.dumps(header, separators=(",", ":"))]
+    for key in sorted(records):
+        lines.append(json.dumps(records[key], separators=(",", ":")))
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=MANIFEST_KEY,
+        Body=("\n".join(lines) + "\n").encode("utf-8"),
+        ContentType="application/x-ndjson",
+        **condition
+    )
+
+# Function to apply changes to the manifest. Changes map a PDF key to its new
+# metadata record, or to None to remove it. When another admin writes the
+# manifest first, the latest version is read again and the changes reapplied.
+def update_manifest(changes):
+    for attempt in range(INDEX_WRITE_ATTEMPTS):
+        header, records, etag = read_manifest()
+        for key, record in changes.items():
+            if record is None:
+                records.pop(key, None)
+            else:
+                records[key] = {"key": key, **record}
+        header = {
+            "version": MANIFEST_VERSION,
+            "revision": header.get("revision", 0) + 1,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+        try:
+            write_manifest(header, records, etag)
+            return
+        except ClientError as e:
+            if not is_write_conflict(e):
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise RuntimeError("The manifest kept changing while it was being updated; please try again.")
+
+# Function to keep the manifest in step with our own changes when manifest
+# mode is on. Failures are shown but do not undo the change to the CSVs.
+def sync_manifest(changes):
+    if not MANIFEST_ENABLED or not changes:
+        return
+    try:
+        update_manifest(changes)
+    except Exception as e:
+        st.error(f"Error updating the metadata manifest: {e}")
+
+# Function to rebuild the manifest from the per-file CSVs, e.g. when manifest
+# mode is first turned on. Returns the number of records and any errors.
+def rebuild_manifest():
+    pdf_keys = list_pdf_keys(BUCKET_NAME, DOCUMENTS_PREFIX)
+    records, errors = fetch_metadata_records(pdf_keys)
+    records = {key: {"key": key, **record} for key, record in records.items()}
+
+    _, _, etag = read_manifest()
+    header = {
+        "version": MANIFEST_VERSION,
+        "revision": 1,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    write_manifest(header, records, etag)
+    return len(records), errors
+
+# Function to load every document's metadata into an in-memory inverted index
+# from department, semester and tag to PDF keys, plus a list of (name, PDF key)
+# sorted by name for the documents whose keys do not carry their names. The
+# index is built once, shared across sessions and updated in place after our
+# own changes; "Refresh File List" rebuilds it to pick up other admins' changes.
+# With manifest mode on it is built from a single read; otherwise the CSVs are
+# fetched in parallel.
+@st.cache_resource(show_spinner="Indexing metadata...")
+def load_metadata_index(bucket_name, prefix):
+    if MANIFEST_ENABLED:
+        _, records, _ = read_manifest()
+    else:
+        records, _ = fetch_metadata_records(list_documents(bucket_name, prefix))
+
+    index = {"lock": threading.Lock(), "records": {}, "by_name": None}
+    for facet in FACETS:
+        index[facet] = {}
+    for key, record in records.items():
+        index_document(index, key, record)
+    # Sorted once here rather than kept sorted while building
+    index["by_name"] = sorted(
+        (document_name(key, record), key) for key, record in records.items() if not is_flat_key(key)
+    )
+    get_loaded_index()["index"] = index
+    return index
+
+# Function to hold the metadata index once it has been built, so changes can
+# be applied to it and earlier records looked up without building it
+@st.cache_resource
+def get_loaded_index():
+    return {"index": None}
+
+# Function to add a document to the index, replacing any earlier entry.
+# Callers must hold the index lock, except while the index is being built.
+def index_document(index, key, record):
+    unindex_document(index, key)
+    index["records"][key] = record
+    if index["by_name"] is not None and not is_flat_key(key):
+        insort(index["by_name"], (document_name(key, record), key))
+    for facet in FACETS:
+        for value in record[facet]:
+            index[facet].setdefault(value, set()).add(key)
+
+def unindex_document(index, key):
+    record = index["records"].pop(key, None)
+    if record is not None:
+        if index["by_name"] is not None and not is_flat_key(key):
+            entry = (document_name(key, record), key)
+            position = bisect_left(index["by_name"], entry)
+            if position < len(index["by_name"]) and index["by_name"][position] == entry:
+                del index["by_name"][position]
+        for facet in FACETS:
+            for value in record[facet]:
+                index[facet].get(value, set()).discard(key)
+
+# Function to apply changes (PDF key -> record, or None when deleted) to the
+# shared metadata index
+def update_metadata_index(changes):
+    index = get_loaded_index()["index"]
+    if index is None:
+        return  # Built later from the CSVs, which already hold the changes
+    with index["lock"]:
+        for key, record in changes.items():
+            if record is None:
+                unindex_document(index, key)
+            else:
+                index_document(index, key, record)
+
+# Function to record metadata changes everywhere they are kept besides the CSVs
+def apply_metadata_changes(changes):
+    sync_manifest(changes)
+    update_metadata_index(changes)
+
+# Function to look up the metadata documents have before a change, so it must
+# be called before the change is written. The in-memory index answers if it has
+# been built; otherwise only these documents' CSVs are read. Documents without
+# metadata map to None.
+def previous_metadata(pdf_keys):
+    index = get_loaded_index()["index"]
+    if index is not None:
+        with index["lock"]:
+            return {pdf_key: index["records"].get(pdf_key) for pdf_key in pdf_keys}
+
+    def read(pdf_key):
+        try:
+            return get_metadata(pdf_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+    with ThreadPoolExecutor(max_workers=METADATA_PREFETCH_WORKERS) as pool:
+        return dict(zip(pdf_keys, pool.map(lambda pdf_key: run_throttled(read, pdf_key), pdf_keys)))
+
+# Function to narrow the sorted file list to names starting with a prefix and
+# to documents matching the selected facets. Within a facet any selected value
+# matches; across facets every facet with a selection must match. Flat keys
+# carry the name, so they are matched on the sorted key list; keys with IDs are
+# matched through the index's sorted names.
+def filter_documents(files, index, name_prefix, selections):
+    matching = files
+    allowed = None
+    with index["lock"]:
+        if name_prefix:
+            key_prefix = DOCUMENTS_PREFIX + name_prefix
+            start = bisect_left(files, key_prefix)
+            end = bisect_left(files, key_prefix + "\uffff")
+            matching = files[start:end]
+            by_name = index["by_name"]
+            if by_name:
+                start = bisect_left(by_name, (name_prefix,))
+                end = bisect_left(by_name, (name_prefix + "\uffff",))
+                named = {key for _, key in by_name[start:end]}
+                matching = [f for f in files if f in named or (f.startswith(key_prefix) and is_flat_key(f))]
+        for facet, values in selections.items():
+            if values:
+                keys = set().union(*(index[facet].get(value, ()) for value in values))
+                allowed = keys if allowed is None else allowed & keys
+    if allowed is not None:
+        matching = [f for f in matching if f in allowed]
+    return matching
+
+# Function to read the content hash index. Returns (SHA-256 -> PDF key, ETag);
+# the ETag is None when no index has been written yet.
+def read_hash_index():
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=HASH_INDEX_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return {}, None
+        raise
+    return json.loads(response["Body"].read()), response["ETag"]
+
+# Function to apply a change to the hash index with a conditional write; the
+# change function receives the whole index dict and edits it in place
+def update_hash_index(change):
+    for attempt in range(INDEX_WRITE_ATTEMPTS):
+        index, etag = read_hash_index()
+        change(index)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=HASH_INDEX_KEY,
+                Body=json.dumps(index, separators=(",", ":")).encode("utf-8"),
+                ContentType="application/json",
+                **condition
+            )
+            return
+        except ClientError as e:
+            if not is_write_conflict(e):
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise RuntimeError("The hash index kept changing while it was being updated; please try again.")
+
+# Function to keep the hash index in step with our own changes. Failures are
+# shown but do not undo the upload or delete.
+def sync_hash_index(change):
+    try:
+        update_hash_index(change)
+    except Exception as e:
+        st.error(f"Error updating the content hash index: {e}")
+
+# Function to make the hash index change for PDFs just written, given as PDF
+# key -> content hash. Hashes the keys had before are dropped first, since
+# those bytes are gone and would otherwise mark new files as duplicates.
+def record_content_hashes(hashes):
+    def change(index):
+        for content_hash in [h for h, key in index.items() if key in hashes]:
+            del index[content_hash]
+        index.update({content_hash: key for key, content_hash in hashes.items()})
+    return change
+
+# Function to drop deleted PDFs from the hash index. Returns the hash each
+# removed PDF had.
+def forget_content_hashes(pdf_keys):
+    if not pdf_keys:
+        return {}
+    deleted = set(pdf_keys)
+    removed = {}  # PDF key -> the hash it had
+    def change(index):
+        for content_hash in [h for h, key in index.items() if key in deleted]:
+            removed[index.pop(content_hash)] = content_hash
+    sync_hash_index(change)
+    return removed
+
+# Function to rebuild the hash index from the stored PDFs. The hash is taken
+# from the object's sha256 metadata when present; older uploads without it are
+# downloaded and hashed once. Returns the number of PDFs indexed and any errors.
+def rebuild_hash_index():
+    pdf_keys = list_pdf_keys(BUCKET_NAME, DOCUMENTS_PREFIX)
+
+    def fetch_hash(key):
+        head = s3.head_object(Bucket=BUCKET_NAME, Key=key)
+        if "sha256" in head.get("Metadata", {}):
+            return head["Metadata"]["sha256"]
+        digest = hashlib.sha256()
+        body = s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"]
+        for chunk in body.iter_chunks(MB):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    index = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = {pool.submit(run_throttled, fetch_hash, key): key for key in pdf_keys}
+        for future in futures:
+            key = futures[future]
+            try:
+                index.setdefault(future.result(), key)
+            except Exception as e:
+                errors.append((key, e))
+
+    def change(current):
+        current.clear()
+        current.update(index)
+    update_hash_index(change)
+    return len(pdf_keys) - len(errors), errors
+
+# Function to build one change feed record. The operation is "upload",
+# "update", "rename" or "delete"; before and after are metadata records, with
+# None where the document did not exist. size is the PDF's size in bytes,
+# where it is known, and previous_size that of a PDF an upload replaced.
+def change_record(operation, pdf_key, content_hash, before, after, previous_key=None, size=None,
+                  previous_size=None):
+    record = {
+        "op": operation,
+        "key": pdf_key,
+        "content_hash": content_hash,
+        "before": before,
+        "after": after,
+    }
+    if previous_key is not None:
+        record["previous_key"] = previous_key
+    if size is not None:
+        record["size"] = size
+    if previous_size is not None:
+        record["previous_size"] = previous_size
+    return record
+
+# Function to reserve a block of sequence numbers for the change feed. The
+# counter object is updated with a conditional write, so two admins never get
+# the same numbers. Returns the first number of the block.
+def allocate_sequence(count):
+    for attempt in range(INDEX_WRITE_ATTEMPTS):
+        try:
+            response = s3.get_object(Bucket=BUCKET_NAME, Key=CHANGES_SEQUENCE_KEY)
+            first = json.loads(response["Body"].read())["next"]
+            condition = {"IfMatch": response["ETag"]}
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise
+            first = 1
+            condition = {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=CHANGES_SEQUENCE_KEY,
+                Body=json.dumps({"next": first + count}).encode("utf-8"),
+                ContentType="application/json",
+                **condition
+            )
+            return first
+        except ClientError as e:
+            if not is_write_conflict(e):
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise RuntimeError("The change feed sequence kept changing; please try again.")
+
+# Function to add change records to the feed as one new object, e.g.
+# changes/date=2026-01-31/00000000000000000042-00000000000000000044.jsonl
+def append_changes(records):
+    if not records:
+        return
+    first = allocate_sequence(len(records))
+    last = first + len(records) - 1
+    now = datetime.now(timezone.utc)
+    lines = []
+    for seq, record in enumerate(records, start=first):
+        lines.append(json.dumps({"seq": seq, "time": now.isoformat(), **record}, separators=(",", ":")))
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=f"{CHANGES_PREFIX}date={now:%Y-%m-%d}/{first:020d}-{last:020d}.jsonl",
+        Body=("\n".join(lines) + "\n").encode("utf-8"),
+        ContentType="application/x-ndjson",
+        IfNoneMatch="*"
+    )
+
+# Function to add change records to the feed and count them in the catalog
+# statistics, from the app. Failures are shown but do not undo the change itself.
+def log_changes(records):
+    sync_catalog_stats(records)
+    try:
+        append_changes(records)
+    except Exception as e:
+        st.error(f"Error writing to the change feed: {e}")
+
+# Function for consumers of the change feed: returns the records with a
+# sequence number above after_seq, in order. The cursor date is the "time" of
+# the last record already processed, so older partitions are not listed; one
+# earlier day is included for batches that were written just after midnight.
+# Reading stops at a gap in the sequence (a batch still being written) unless
+# the gap is older than CHANGES_GAP_TIMEOUT_SECONDS.
+def read_changes(after_seq=0, cursor_time=None):
+    partitions = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{CHANGES_PREFIX}date=", Delimiter="/"):
+        for prefix in page.get("CommonPrefixes", []):
+            partitions.append(prefix["Prefix"])
+    if cursor_time:
+        start_day = (datetime.fromisoformat(cursor_time) - timedelta(days=1)).strftime("%Y-%m-%d")
+        partitions = [p for p in partitions if p >= f"{CHANGES_PREFIX}date={start_day}/"]
+
+    records = []
+    for partition in partitions:
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=partition):
+            for obj in page.get("Contents", []):
+                last = int(obj["Key"].rsplit("-", 1)[-1][:-len(".jsonl")])
+                if last <= after_seq:
+                    continue
+                body = s3.get_object(Bucket=BUCKET_NAME, Key=obj["Key"])["Body"].read().decode("utf-8")
+                records.extend(json.loads(line) for line in body.splitlines() if line)
+    records.sort(key=lambda record: record["seq"])
+
+    ordered = []
+    expected = after_seq + 1
+    for record in records:
+        if record["seq"] < expected:
+            continue
+        if record["seq"] > expected:
+            age = datetime.now(timezone.utc) - datetime.fromisoformat(record["time"])
+            if age.total_seconds() < CHANGES_GAP_TIMEOUT_SECONDS:
+                break
+        ordered.append(record)
+        expected = record["seq"] + 1
+    return ordered
+
+# Function to start empty catalog statistics. "cells" maps department ->
+# semester -> tag -> [documents, bytes], where "*" stands for any value, so a
+# question like "how many S7 lecture notes does one department have" is a
+# single lookup. "uploads_by_day" maps a date to [documents, bytes] uploaded.
+def empty_catalog_stats():
+    return {"version": CATALOG_STATS_VERSION, "cells": {}, "uploads_by_day": {}, "recent_uploads": []}
+
+# Function to read the catalog statistics. Returns (statistics, ETag); the
+# ETag is None when none have been written yet.
+def read_catalog_stats():
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=CATALOG_STATS_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return empty_catalog_stats(), None
+        raise
+    stats = json.loads(response["Body"].read())
+    if stats.get("version") != CATALOG_STATS_VERSION:
+        raise ValueError(f"Unsupported statistics version {stats.get('version')}")
+    return stats, response["ETag"]
+
+# Function to apply a change to the catalog statistics with a conditional
+# write; the change function receives the statistics and edits them in place
+def update_catalog_stats(change):
+    for attempt in range(INDEX_WRITE_ATTEMPTS):
+        stats, etag = read_catalog_stats()
+        change(stats)
+        stats["updated_at"] = datetime.now(timezone.utc).isoformat()
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=CATALOG_STATS_KEY,
+                Body=json.dumps(stats, separators=(",", ":")).encode("utf-8"),
+                ContentType="application/json",
+                **condition
+            )
+            return
+        except ClientError as e:
+            if not is_write_conflict(e):
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise RuntimeError("The catalog statistics kept changing while they were being updated; please try again.")
+
+# Function to add (documents=1) or remove (documents=-1) one document with
+# the given metadata record in every cell it belongs to. Empty cells are dropped.
+def count_document(stats, record, documents, size):
+    departments = [*dict.fromkeys(record["departments"]), "*"]
+    semesters = [*dict.fromkeys(record["semesters"]), "*"]
+    tags = [*dict.fromkeys(record["tags"]), "*"]
+    cells = stats["cells"]
+    for department in departments:
+        by_semester = cells.setdefault(department, {})
+        for semester in semesters:
+            by_tag = by_semester.setdefault(semester, {})
+            for tag in tags:
+                cell = by_tag.setdefault(tag, [0, 0])
+                cell[0] += documents
+                cell[1] += documents * size
+                if cell[0] <= 0:
+                    del by_tag[tag]
+            if not by_tag:
+                del by_semester[semester]
+        if not by_semester:
+            del cells[department]
+
+# Function to count a batch of change feed records in the statistics. Only
+# changes to a document's departments, semesters or tags move it between cells.
+def count_changes(stats, records):
+    now = datetime.now(timezone.utc)
+    for record in records:
+        before, after = record["before"], record["after"]
+        size = record.get("size") or 0
+        previous_size = record.get("previous_size", size)
+        moved = not (before and after and all(set(before[facet]) == set(after[facet]) for facet in FACETS))
+        if before and (moved or previous_size != size):
+            count_document(stats, before, -1, previous_size)
+        if after and (moved or previous_size != size):
+            count_document(stats, after, 1, size)
+
+        if record["op"] == "upload":
+            day = stats["uploads_by_day"].setdefault(f"{now:%Y-%m-%d}", [0, 0])
+            day[0] += 1
+            day[1] += size
+            stats["recent_uploads"].insert(0, {
+                "key": record["key"],
+                "name": after["file_name"],
+                "size": size,
+                "time": now.isoformat(),
+            })
+
+    del stats["recent_uploads"][RECENT_UPLOADS:]
+    oldest = f"{now - timedelta(days=UPLOAD_ACTIVITY_DAYS - 1):%Y-%m-%d}"
+    for day in [day for day in stats["uploads_by_day"] if day < oldest]:
+        del stats["uploads_by_day"][day]
+
+# Function to keep the statistics in step with our own changes. Failures are
+# shown but do not undo the change.
+def sync_catalog_stats(records):
+    if not records:
+        return
+    try:
+        update_catalog_stats(lambda stats: count_changes(stats, records))
+        load_catalog_stats.clear()
+    except Exception as e:
+        st.error(f"Error updating the catalog statistics: {e}")
+
+# Function to get the catalog statistics for the home page, shared across
+# sessions and reruns until the TTL expires or our own changes update them
+@st.cache_data(ttl=CATALOG_TTL_SECONDS, show_spinner=False)
+def load_catalog_stats():
+    return read_catalog_stats()[0]
+
+# Function to count every stored document again, e.g. for documents stored
+# before statistics were kept. Upload activity is kept as it was. Returns the
+# number of documents counted and any errors reading their metadata.
+def rebuild_catalog_stats():
+    pdf_keys = list_pdf_keys(BUCKET_NAME, DOCUMENTS_PREFIX)
+    if MANIFEST_ENABLED:
+        _, records, _ = read_manifest()
+        errors = []
+    else:
+        records, errors = fetch_metadata_records(pdf_keys)
+    sizes = document_sizes(pdf_keys)
+    counted = [pdf_key for pdf_key in pdf_keys if pdf_key in records]
+
+    def change(stats):
+        stats["cells"] = {}
+        for pdf_key in counted:
+            count_document(stats, records[pdf_key], 1, sizes[pdf_key] or 0)
+    update_catalog_stats(change)
+    load_catalog_stats.clear()
+    return len(counted), errors
+
+# Callback for the "Rebuild Statistics" button, run before the page is redrawn
+def rebuild_stats():
+    try:
+        count, errors = rebuild_catalog_stats()
+        st.session_state.stats_rebuild_result = (count, errors, None)
+    except Exception as e:
+        st.session_state.stats_rebuild_result = (0, [], e)
+
+# Function to list documents and bytes for each value of one facet, from the
+# cells where the other two facets are "*". Values not in the predefined list
+# but found in the metadata are shown after the predefined ones.
+def facet_totals(stats, facet, values):
+    cells = stats["cells"]
+    if facet == "departments":
+        found = {value: by_semester.get("*", {}).get("*") for value, by_semester in cells.items()}
+    elif facet == "semesters":
+        found = {value: by_tag.get("*") for value, by_tag in cells.get("*", {}).items()}
+    else:
+        found = cells.get("*", {}).get("*", {})
+    found = {value: cell for value, cell in found.items() if value != "*" and cell}
+    rows = []
+    for value in dict.fromkeys([*values, *found]):
+        documents, size = found.get(value, [0, 0])
+        rows.append({facet[:-1]: value, "documents": documents, "MB": round(size / MB, 1)})
+    return rows
+
+# Function to keep the name and metadata entered for each uploaded file. Cards
+# on other pages of the grid are not drawn, so their values cannot be kept in
+# widget state; they are stored per file here instead.
+def upload_metadata(uploaded_files):
+    previous = st.session_state.get("upload_metadata", {})
+    metadata = {}
+    for uploaded_file in uploaded_files:
+        metadata[uploaded_file["file_id"]] = previous.get(uploaded_file["file_id"]) or {
+            "name": uploaded_file["name"].replace(".pdf", ""),
+            "departments": [],
+            "semesters": [],
+            "tags": [],
+            "selected": False,
+        }
+    st.session_state.upload_metadata = metadata
+    return metadata
+
+# Function to drop the widget state of the given cards, so they are drawn from
+# upload_metadata again
+def reset_upload_cards(file_ids):
+    for file_id in file_ids:
+        for prefix in ("name", "dept", "sem", "tags", "select"):
+            st.session_state.pop(f"{prefix}_{file_id}", None)
+
+# Callback for the upload grid's submit buttons: stores the cards of the page
+# that was shown, then moves to another page if asked to
+def save_upload_page(file_ids, move=0):
+    metadata = st.session_state.upload_metadata
+    for file_id in file_ids:
+        metadata[file_id] = {
+            "name": st.session_state[f"name_{file_id}"],
+            "departments": st.session_state[f"dept_{file_id}"],
+            "semesters": st.session_state[f"sem_{file_id}"],
+            "tags": st.session_state[f"tags_{file_id}"],
+            "selected": st.session_state[f"select_{file_id}"],
+        }
+    st.session_state.upload_grid_page += move
+
+# Callback for "Apply to All Files" and "Apply to Selected Files". Fields left
+# empty keep each file's own values.
+def apply_upload_metadata(file_ids, selected_only):
+    save_upload_page(file_ids)
+    fields = {
+        "departments": st.session_state.bulk_upload_dept,
+        "semesters": st.session_state.bulk_upload_sem,
+        "tags": st.session_state.bulk_upload_tags,
+    }
+    fields = {field: list(values) for field, values in fields.items() if values}
+
+    metadata = st.session_state.upload_metadata
+    targets = [file_id for file_id, entry in metadata.items() if entry["selected"] or not selected_only]
+    for file_id in targets:
+        metadata[file_id].update(fields)
+    reset_upload_cards(file_ids)
+    st.session_state.upload_grid_message = f"Metadata applied to {len(targets)} file(s)."
+
+# Homepage
+def homepage():
+    st.write("Welcome to the PDF Upload and Management System!")
+    st.write("Use the navigation sidebar to switch between pages.")
+
+    if "stats_rebuild_result" in st.session_state:
+        count, errors, error = st.session_state.pop("stats_rebuild_result")
+        if error:
+            st.error(f"Error rebuilding the catalog statistics: {error}")
+        else:
+            st.success(f"Catalog statistics rebuilt from {count} documents.")
+        for key, e in errors:
+            st.error(f"Error reading metadata for {key}: {e}")
+
+    # Counts come from one small object kept up to date with every change,
+    # so the page costs the same however large the catalog is
+    try:
+        stats = load_catalog_stats()
+    except Exception as e:
+        st.error(f"Error loading the catalog statistics: {e}")
+        return
+    cells = stats["cells"]
+    documents, size = cells.get("*", {}).get("*", {}).get("*", [0, 0])
+    today = datetime.now(timezone.utc)
+    days = [f"{today - timedelta(days=n):%Y-%m-%d}" for n in reversed(range(UPLOAD_ACTIVITY_DAYS))]
+    uploads = [stats["uploads_by_day"].get(day, [0, 0]) for day in days]
+
+    st.write("### Catalog")
+    cols = st.columns(3)
+    cols[0].metric("Documents", f"{documents:,}")
+    cols[1].metric("Total size", f"{size / MB:,.1f} MB")
+    cols[2].metric("Uploaded in the last 7 days", f"{sum(count for count, _ in uploads[-7:]):,}")
+    if not cells:
+        st.info("No documents have been counted yet. New changes are counted from now on; "
+                "use Rebuild Statistics below to count the documents already stored.")
+
+    # Documents with one department, semester and tag, e.g. S7 lecture notes
+    cols = st.columns(3)
+    with cols[0]:
+        department = st.selectbox("Department", ["Any"] + DEPARTMENTS, key="stats_dept")
+    with cols[1]:
+        semester = st.selectbox("Semester", ["Any"] + SEMESTERS, key="stats_sem")
+    with cols[2]:
+        tag = st.selectbox("Tag", ["Any"] + PREDEFINED_TAGS, key="stats_tag")
+    cell = (
+        cells.get("*" if department == "Any" else department, {})
+        .get("*" if semester == "Any" else semester, {})
+        .get("*" if tag == "Any" else tag, [0, 0])
+    )
+    st.write(f"**{cell[0]:,}** matching document(s), {cell[1] / MB:,.1f} MB")
+
+    # Totals for every department, semester and tag
+    tabs = st.tabs(["By Department", "By Semester", "By Tag"])
+    for tab, facet, values in zip(tabs, FACETS, (DEPARTMENTS, SEMESTERS, PREDEFINED_TAGS)):
+        with tab:
+            rows = facet_totals(stats, facet, values)
+            st.bar_chart(rows, x=facet[:-1], y="documents", horizontal=True)
+            st.dataframe(rows, hide_index=True)
+
+    st.write("### Recent Uploads")
+    st.bar_chart(
+        [{"day": day, "documents": count} for day, (count, _) in zip(days, uploads)],
+        x="day",
+        y="documents"
+    )
+    if stats["recent_uploads"]:
+        st.dataframe(
+            [
+                {
+                    "file": upload["name"],
+                    "MB": round(upload["size"] / MB, 2),
+                    "uploaded": datetime.fromisoformat(upload["time"]).strftime("%Y-%m-%d %H:%M UTC"),
+                }
+                for upload in stats["recent_uploads"]
+            ],
+            hide_index=True
+        )
+
+    with st.expander("Rebuild Statistics"):
+        st.write(f"The statistics are kept in `{CATALOG_STATS_KEY}` and updated with every upload, edit and delete. "
+                 "Rebuilding reads the metadata of every document once.")
+        st.button("Rebuild Statistics", on_click=rebuild_stats)
+
+# Upload page
+def upload_page():
+    st.write("### Upload PDFs")
+    
+    # File uploader for multiple PDFs. Selected files are moved to the list of
+    # files waiting to be uploaded and the uploader is emptied for the next ones.
+    generation = st.session_state.get("uploader_generation", 0)
+    selected_files = st.file_uploader(
+        "Upload PDFs", type="pdf", accept_multiple_files=True, key=f"pdf_uploader_{generation}"
+    )
+    if selected_files:
+        stage_uploads(selected_files)
+        st.session_state.uploader_generation = generation + 1
+        st.rerun()
+    uploaded_files = st.session_state.get("staged_uploads", [])
+
+    # Memory taken by files waiting to be uploaded, across all users
+    used = upload_memory_in_use()
+    st.progress(
+        min(used / UPLOAD_MEMORY_BUDGET, 1.0),
+        text=f"Upload memory in use: {used / MB:.1f} of {UPLOAD_MEMORY_BUDGET / MB:.0f} MB"
+    )
+    spooled = [entry for entry in uploaded_files if entry["path"]]
+    if spooled:
+        st.caption(
+            f"{len(spooled)} file(s) ({sum(entry['size'] for entry in spooled) / MB:.1f} MB) "
+            "are waiting on disk and will be streamed to S3."
+        )
+    if uploaded_files:
+        st.button("Clear Files", on_click=clear_staged_uploads)
+    
+    # Number of files sent to S3 at the same time
+    max_workers = st.number_input(
+        "Parallel uploads",
+        min_value=1,
+        max_value=32,
+        value=UPLOAD_WORKERS,
+        key="upload_workers"
+    )
+
+    # Skip files whose exact bytes are already stored under another name
+    skip_duplicates = st.checkbox("Skip files already in the bucket", value=True, key="skip_duplicates")
+
+    # Store each PDF's text next to it, so the RAG pipeline need not parse it again
+    extract = st.checkbox(
+        "Extract text and page count",
+        value=EXTRACTION_ENABLED,
+        disabled=not EXTRACTION_AVAILABLE,
+        help=f"Stored next to each PDF as <name>{SIDECAR_SUFFIX}." if EXTRACTION_AVAILABLE
+        else "Install pypdf to enable text extraction.",
+        key="extract_text"
+    )
+
+    # Display uploaded files in a grid, one page of cards at a time. The cards
+    # are in a form, so editing them does not rerun the page; their values are
+    # stored when one of the form's buttons is pressed.
+    upload_clicked = False
+    if uploaded_files:
+        metadata = upload_metadata(uploaded_files)
+        page_count = (len(uploaded_files) - 1) // UPLOAD_PAGE_SIZE + 1
+        page = min(st.session_state.setdefault("upload_grid_page", 0), page_count - 1)
+        st.session_state.upload_grid_page = page
+        first = page * UPLOAD_PAGE_SIZE
+        page_files = uploaded_files[first:first + UPLOAD_PAGE_SIZE]
+        page_ids = [uploaded_file["file_id"] for uploaded_file in page_files]
+
+        st.subheader("Uploaded PDFs")
+        if "upload_grid_message" in st.session_state:
+            st.success(st.session_state.pop("upload_grid_message"))
+
+        with st.form("upload_grid"):
+            # Metadata set for many files at once
+            with st.expander("Apply Metadata to Several Files"):
+                st.multiselect("Department(s)", options=["All"] + DEPARTMENTS, key="bulk_upload_dept")
+                st.multiselect("Semester(s)", options=["All"] + SEMESTERS, key="bulk_upload_sem")
+                st.multiselect("Tags", options=PREDEFINED_TAGS, key="bulk_upload_tags")
+                st.caption("Fields left empty keep each file's own values.")
+                apply_all, apply_selected = st.columns(2)
+                with apply_all:
+                    st.form_submit_button(
+                        "Apply to All Files", on_click=apply_upload_metadata, args=(page_ids, False)
+                    )
+                with apply_selected:
+                    st.form_submit_button(
+                        "Apply to Selected Files", on_click=apply_upload_metadata, args=(page_ids, True)
+                    )
+
+            cols = st.columns(2)  # 2-column grid
+            for i, uploaded_file in enumerate(page_files, start=first):
+                file_id = uploaded_file["file_id"]
+                entry = metadata[file_id]
+                with cols[i % 2]:  # Distribute files across columns
+                    st.write(f"**File {i + 1}**")
+                    st.checkbox("Select", value=entry["selected"], key=f"select_{file_id}")
+
+                    # Display file name (editable, without .pdf extension)
+                    st.text_input(f"Name for File {i + 1}", value=entry["name"], key=f"name_{file_id}")
+
+                    # Department selection (multi-select dropdown with "All" option)
+                    st.multiselect(
+                        f"Department(s) for File {i + 1}",
+                        options=["All"] + DEPARTMENTS,  # Add "All" option
+                        default=entry["departments"],
+                        key=f"dept_{file_id}"
+                    )
+
+                    # Semester selection (multi-select dropdown with "All" option)
+                    st.multiselect(
+                        f"Semester(s) for File {i + 1}",
+                        options=["All"] + SEMESTERS,  # Add "All" option
+                        default=entry["semesters"],
+                        key=f"sem_{file_id}"
+                    )
+
+                    # Tags selection (multi-select dropdown)
+                    st.multiselect(
+                        f"Tags for File {i + 1}",
+                        options=PREDEFINED_TAGS,
+                        default=entry["tags"],
+                        key=f"tags_{file_id}"
+                    )
+
+                    st.write("---")  # Separator between files
+
+            st.caption(
+                f"Page {page + 1} of {page_count}, files {first + 1}-{first + len(page_files)} "
+                f"of {len(uploaded_files)}. Changes are kept when any button below is pressed."
+            )
+            previous_col, next_col, save_col, upload_col = st.columns(4)
+            with previous_col:
+                st.form_submit_button(
+                    "Previous Page", on_click=save_upload_page, args=(page_ids, -1), disabled=page == 0
+                )
+            with next_col:
+                st.form_submit_button(
+                    "Next Page", on_click=save_upload_page, args=(page_ids, 1), disabled=page == page_count - 1
+                )
+            with save_col:
+                st.form_submit_button("Save Changes", on_click=save_upload_page, args=(page_ids,))
+            with upload_col:
+                upload_clicked = st.form_submit_button(
+                    "Upload All Files", on_click=save_upload_page, args=(page_ids,)
+                )
+    else:
+        upload_clicked = st.button("Upload All Files")
+
+    # Upload button
+    if upload_clicked:
+        # Names become keys, so every file needs a usable one before any is sent
+        invalid = []
+        for uploaded_file in uploaded_files:
+            try:
+                check_document_name(st.session_state.upload_metadata[uploaded_file["file_id"]]["name"])
+            except ValueError as e:
+                invalid.append((uploaded_file["name"], e))
+        if invalid:
+            for name, error in invalid:
+                st.error(f"Cannot upload {name}: {error}")
+        elif uploaded_files:
+            # Collect everything the workers need up front; they cannot read session state
+            jobs = []
+            for uploaded_file in uploaded_files:
+                entry = st.session_state.upload_metadata[uploaded_file["file_id"]]
+                jobs.append({
+                    "key": new_document_key(entry["name"], entry["departments"], doc_id=uploaded_file["doc_id"]),
+                    "file": uploaded_file["file"],
+                    "path": uploaded_file["path"],
+                    "name": entry["name"],
+                    "size": uploaded_file["size"],
+                    "departments": entry["departments"],
+                    "semesters": entry["semesters"],
+                    "tags": entry["tags"],
+                })
+
+            # Hashes of the PDFs already in the bucket
+            try:
+                known_hashes, _ = read_hash_index()
+            except Exception as e:
+                st.warning(f"Could not load the content hash index, duplicates will not be detected: {e}")
+                known_hashes = {}
+
+            # Metadata the keys had before, read before the upload overwrites it
+            try:
+                before = previous_metadata([job["key"] for job in jobs])
+            except Exception as e:
+                st.warning(f"Could not read the files' earlier metadata, the change feed will lack it: {e}")
+                before = {}
+            previous_sizes = document_sizes([key for key, record in before.items() if record])
+
+            # Each file's memory or disk space is freed as soon as it is stored
+            results = upload_documents(
+                jobs,
+                int(max_workers),
+                known_hashes,
+                skip_duplicates,
+                on_done=lambda i: release_staged_upload(uploaded_files[i]),
+                extract=extract
+            )
+            st.session_state.staged_uploads = [
+                uploaded_file
+                for uploaded_file, (_, error, _, _) in zip(uploaded_files, results)
+                if error is not None
+            ]
+            uploaded = [
+                (job, content_hash)
+                for job, (_, error, duplicate_of, content_hash) in zip(jobs, results)
+                if error is None and not (skip_duplicates and duplicate_of)
+            ]
+
+            # Make the new files show up on the edit page
+            invalidate_catalog()
+            changes = {
+                job["key"]: metadata_record(job["name"], job["departments"], job["semesters"], job["tags"])
+                for job, _ in uploaded
+            }
+            apply_metadata_changes(changes)
+            remember_document_sizes({job["key"]: job["size"] for job, _ in uploaded})
+            if uploaded:
+                sync_hash_index(record_content_hashes({job["key"]: content_hash for job, content_hash in uploaded}))
+            log_changes([
+                change_record(
+                    "upload", job["key"], content_hash, before.get(job["key"]), changes[job["key"]],
+                    size=job["size"], previous_size=previous_sizes.get(job["key"])
+                )
+                for job, content_hash in uploaded
+            ])
+
+            # Summary of the batch
+            failures = [(name, error) for name, error, _, _ in results if error is not None]
+            duplicates = [(name, duplicate_of) for name, error, duplicate_of, _ in results if error is None and duplicate_of]
+            if failures:
+                st.error(f"{len(failures)} of {len(results)} files failed to upload.")
+                for name, error in failures:
+                    st.error(f"Error uploading {name}.pdf: {error}")
+            for name, duplicate_of in duplicates:
+                if skip_duplicates:
+                    st.info(f"Skipped {name}.pdf: same content as {duplicate_of}.")
+                else:
+                    st.info(f"Uploaded {name}.pdf although it has the same content as {duplicate_of}.")
+            for job in jobs:
+                if job.get("extract_error"):
+                    st.warning(f"{job['name']}.pdf was uploaded, but its text could not be extracted: {job['extract_error']}")
+            if uploaded:
+                st.success(f"{len(uploaded)} of {len(results)} files and their metadata uploaded to S3.")
+        else:
+            st.warning("No files uploaded.")
+
+    # Send files from the browser straight to the bucket; only their metadata
+    # passes through this server
+    if DIRECT_UPLOADS_ENABLED:
+        batch = st.session_state.get("direct_upload")
+        with st.expander("Direct Upload", expanded=batch is not None or "direct_upload_message" in st.session_state):
+            if batch is None:
+                st.write(
+                    f"Up to {DIRECT_UPLOAD_FILES} PDFs of at most {DIRECT_UPLOAD_MAX_BYTES // MB} MB each are "
+                    "sent from your browser to S3. The metadata below is given to every file in the batch."
+                )
+                st.multiselect("Department(s)", options=["All"] + DEPARTMENTS, key="direct_upload_dept")
+                st.multiselect("Semester(s)", options=["All"] + SEMESTERS, key="direct_upload_sem")
+                st.multiselect("Tags", options=PREDEFINED_TAGS, key="direct_upload_tags")
+                if st.button("Start Direct Upload"):
+                    departments = st.session_state.direct_upload_dept
+                    try:
+                        st.session_state.direct_upload = {
+                            "id": uuid.uuid4().hex,
+                            "slots": presign_direct_uploads(DIRECT_UPLOAD_FILES, departments),
+                            "recorded": set(),
+                            "departments": departments,
+                            "semesters": st.session_state.direct_upload_sem,
+                            "tags": st.session_state.direct_upload_tags,
+                            "expires": time.time() + DIRECT_UPLOAD_EXPIRY_SECONDS,
+                        }
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Error preparing the direct upload: {e}")
+            else:
+                expires = datetime.fromtimestamp(batch["expires"]).strftime("%H:%M")
+                st.caption(
+                    f"Department(s): {', '.join(batch['departments']) or 'none'}; "
+                    f"Semester(s): {', '.join(batch['semesters']) or 'none'}; "
+                    f"Tags: {', '.join(batch['tags']) or 'none'}. Files must be sent before {expires}."
+                )
+                if time.time() < batch["expires"]:
+                    st.iframe(direct_upload_html(batch["id"], batch["slots"]), height=300)
+                else:
+                    st.warning("This batch has expired; record the files already sent and start a new one.")
+
+                record_col, cancel_col = st.columns(2)
+                with record_col:
+                    record_clicked = st.button("Record Sent Files")
+                with cancel_col:
+                    if st.button("Close Batch"):
+                        del st.session_state.direct_upload
+                        st.rerun()
+
+                if record_clicked:
+                    # Only keys the browser has sent a PDF to become documents
+                    slot_keys = [slot["key"] for slot in batch["slots"] if slot["key"] not in batch["recorded"]]
+                    with ThreadPoolExecutor(max_workers=int(max_workers)) as pool:
+                        futures = [pool.submit(run_throttled, check_direct_upload, key) for key in slot_keys]
+                    arrived = {}
+                    failed = []
+                    for pdf_key, future in zip(slot_keys, futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            failed.append((pdf_key, e))
+                            continue
+                        if result is not None:
+                            arrived[pdf_key] = result
+
+                    changes = {}
+                    for pdf_key, (size, file_name) in arrived.items():
+                        record = metadata_record(file_name, batch["departments"], batch["semesters"], batch["tags"])
+                        try:
+                            put_metadata_csv(pdf_key, record)
+                        except Exception as e:
+                            failed.append((pdf_key, e))
+                            continue
+                        changes[pdf_key] = record
+
+                    if changes:
+                        invalidate_catalog()
+                        apply_metadata_changes(changes)
+                        remember_document_sizes({pdf_key: arrived[pdf_key][0] for pdf_key in changes})
+                        log_changes([
+                            change_record("upload", pdf_key, None, None, record, size=arrived[pdf_key][0])
+                            for pdf_key, record in changes.items()
+                        ])
+                    st.session_state.direct_upload_errors = [
+                        f"Error recording {pdf_key}: {error}" for pdf_key, error in failed
+                    ]
+
+                    # Recorded slots are done; the others stay open for more files,
+                    # and failed ones are checked again next time
+                    batch["recorded"].update(changes)
+                    if changes:
+                        st.session_state.direct_upload_message = f"Recorded {len(changes)} file(s) sent to S3."
+                        if len(batch["recorded"]) == len(batch["slots"]):
+                            del st.session_state.direct_upload
+                        st.rerun()
+                    else:
+                        for error in st.session_state.pop("direct_upload_errors"):
+                            st.error(error)
+                        if not failed:
+                            st.info("No files have arrived yet.")
+
+            # Below the form, so showing them does not move it and redraw it
+            if "direct_upload_message" in st.session_state:
+                st.success(st.session_state.pop("direct_upload_message"))
+                for error in st.session_state.pop("direct_upload_errors", []):
+                    st.error(error)
+
+    # Seed the hash index, e.g. for files uploaded before duplicates were tracked
+    with st.expander("Duplicate Detection"):
+        st.write(f"Content hashes of stored PDFs are kept in `{HASH_INDEX_KEY}`.")
+        if st.button("Rebuild Hash Index"):
+            try:
+                count, errors = rebuild_hash_index()
+                st.success(f"Hash index rebuilt from {count} PDFs.")
+                for key, error in errors:
+                    st.error(f"Error hashing {key}: {error}")
+            except Exception as e:
+                st.error(f"Error rebuilding hash index: {e}")
+
+    # Clean up multipart uploads that were interrupted and never resumed
+    with st.expander("Incomplete Uploads"):
+        older_than_hours = st.number_input(
+            "Abort incomplete uploads older than (hours)",
+            min_value=0,
+            value=STALE_UPLOAD_HOURS,
+            key="stale_upload_hours"
+        )
+        if st.button("Abort Stale Uploads"):
+            try:
+                aborted = abort_stale_uploads(BUCKET_NAME, DOCUMENTS_PREFIX, older_than_hours)
+                if aborted:
+                    st.success(f"Aborted {len(aborted)} incomplete upload(s): {', '.join(aborted)}")
+                else:
+                    st.info("No incomplete uploads to abort.")
+            except Exception as e:
+                st.error(f"Error aborting incomplete uploads: {e}")
+
+# Edit page
+def edit_page():
+    st.write("### Edit Existing Files")
+
+    # Force a fresh listing, e.g. to pick up changes made by other admins
+    if st.button("Refresh File List"):
+        invalidate_catalog()
+        load_metadata_index.clear()
+        get_loaded_index()["index"] = None
+
+    # Rebuild the manifest from the CSVs, e.g. right after turning manifest mode on
+    if MANIFEST_ENABLED:
+        with st.expander("Metadata Manifest"):
+            st.write(f"All metadata is also kept in `{MANIFEST_KEY}`.")
+            if st.button("Rebuild Manifest"):
+                try:
+                    count, errors = rebuild_manifest()
+                    st.success(f"Manifest rebuilt with {count} documents.")
+                    for key, error in errors:
+                        st.error(f"Error reading metadata for {key}: {error}")
+                except Exception as e:
+                    st.error(f"Error rebuilding manifest: {e}")
+
+    # List all files in the S3 bucket (cached between reruns)
+    try:
+        files = list_documents(BUCKET_NAME, DOCUMENTS_PREFIX)
+    except Exception as e:
+        st.error(f"Error listing files from S3: {e}")
+        return
+    if not files:
+        st.warning("No files found in the S3 bucket.")
+        return
+
+    # Narrow the file list by name and metadata using the in-memory index
+    try:
+        index = load_metadata_index(BUCKET_NAME, DOCUMENTS_PREFIX)
+    except Exception as e:
+        st.error(f"Error loading metadata for filtering: {e}")
+        return
+    name_prefix = st.text_input("Name starts with", key="filter_prefix")
+    cols = st.columns(3)
+    with cols[0]:
+        filter_departments = st.multiselect("Filter by department", DEPARTMENTS, key="filter_dept")
+    with cols[1]:
+        filter_semesters = st.multiselect("Filter by semester", SEMESTERS, key="filter_sem")
+    with cols[2]:
+        filter_tags = st.multiselect("Filter by tag", PREDEFINED_TAGS, key="filter_tags")
+    filtered = filter_documents(files, index, name_prefix, {
+        "departments": filter_departments,
+        "semesters": filter_semesters,
+        "tags": filter_tags,
+    })
+    st.caption(f"{len(filtered)} of {len(files)} files match")
+
+    # Names shown for the documents; keys with IDs need their metadata for it
+    records = index["records"]
+    def label(pdf_key):
+        return document_label(pdf_key, records.get(pdf_key))
+    # Keys with IDs sort in random order, so list documents by name instead
+    if KEY_LAYOUT != "flat":
+        filtered = sorted(filtered, key=label)
+
+    # Delete many files at once, picked by hand or from the filtered list
+    with st.expander("Bulk Delete"):
+        if "bulk_delete_result" in st.session_state:
+            deleted, errors = st.session_state.pop("bulk_delete_result")
+            if deleted:
+                st.success(f"Deleted {len(deleted)} file(s) and their metadata.")
+            for key, error in errors:
+                st.error(f"Error deleting {label(key)}: {error}")
+
+        name_filter = st.text_input("Only files whose name contains", key="bulk_delete_filter")
+        matching = [f for f in filtered if name_filter.lower() in label(f).lower()]
+        if st.checkbox(f"Select all {len(matching)} matching files", key="bulk_delete_all"):
+            targets = matching
+        else:
+            targets = st.multiselect("Files to delete", matching, format_func=label, key="bulk_delete_files")
+        confirmed = st.checkbox(
+            f"I understand that {len(targets)} file(s) and their metadata will be permanently deleted",
+            key="bulk_delete_confirm"
+        )
+        st.button(
+            "Delete Selected Files",
+            disabled=not (targets and confirmed),
+            on_click=bulk_delete,
+            args=(targets,)
+        )
+
+    # Rename many files at once by replacing part of their names
+    with st.expander("Bulk Rename"):
+        if "bulk_rename_result" in st.session_state:
+            renamed, errors = st.session_state.pop("bulk_rename_result")
+            if renamed:
+                st.success(f"Renamed {len(renamed)} file(s).")
+            for key, error in errors:
+                st.error(f"Error renaming {label(key)}: {error}")
+
+        find = st.text_input("Find in file names", key="bulk_rename_find")
+        replace = st.text_input("Replace with", key="bulk_rename_replace")
+        renames = {}
+        if find:
+            taken = set(files)
+            preview = []
+            for pdf_key in filtered:
+                name = document_name(pdf_key, records.get(pdf_key))
+                if find not in name:
+                    continue
+                new_name = name.replace(find, replace)
+                # Only flat keys are named after their documents and can clash
+                new_key = new_document_key(new_name, [], layout="flat") if is_flat_key(pdf_key) else pdf_key
+                if not new_name or "/" in new_name:
+                    problem = "invalid name"
+                elif is_flat_key(pdf_key) and new_key in taken:
+                    problem = "name already in use"
+                else:
+                    problem = ""
+                    renames[pdf_key] = new_name
+                    taken.add(new_key)
+                preview.append({"file": label(pdf_key), "new name": new_name, "problem": problem})
+            st.dataframe(preview, hide_index=True)
+        st.button(
+            f"Rename {len(renames)} File(s)",
+            disabled=not renames,
+            on_click=bulk_rename,
+            args=(renames, UPLOAD_WORKERS)
+        )
+
+    # Add, remove or replace departments, semesters and tags of many files at once
+    with st.expander("Bulk Edit Metadata"):
+        if "bulk_edit_result" in st.session_state:
+            edited, unchanged, errors = st.session_state.pop("bulk_edit_result")
+            if edited:
+                st.success(f"Updated the metadata of {len(edited)} file(s).")
+            if unchanged:
+                st.info(f"{unchanged} file(s) already had this metadata and were left as they were.")
+            for key, error in errors:
+                st.error(f"Error updating {label(key)}: {error}")
+
+        if st.checkbox(f"Select all {len(filtered)} filtered files", key="bulk_edit_all"):
+            targets = filtered
+        else:
+            targets = st.multiselect("Files to edit", filtered, format_func=label, key="bulk_edit_files")
+
+        facet_options = {
+            "departments": ("Department(s)", ["All"] + DEPARTMENTS, DEPARTMENTS),
+            "semesters": ("Semester(s)", ["All"] + SEMESTERS, SEMESTERS),
+            "tags": ("Tags", PREDEFINED_TAGS, PREDEFINED_TAGS),
+        }
+        operations = {}
+        for facet, (title, options, every) in facet_options.items():
+            action_col, values_col = st.columns([1, 3])
+            with action_col:
+                action = st.selectbox(
+                    title, ["Keep", "Add", "Remove", "Replace with"], key=f"bulk_edit_{facet}_action"
+                )
+            with values_col:
+                values = st.multiselect(
+                    f"{title} to {action.lower()}",
+                    options,
+                    disabled=action == "Keep",
+                    key=f"bulk_edit_{facet}_values"
+                )
+            if action != "Keep":
+                if "All" in values:
+                    values = every
+                operations[facet] = (action.split()[0].lower(), values)
+
+        # Only files whose metadata would change are listed and written
+        changed = []
+        if operations and targets:
+            preview = []
+            for pdf_key in targets:
+                record = records.get(pdf_key)
+                if record is None:
+                    continue
+                edited_record = edit_record(record, operations)
+                if edited_record == record:
+                    continue
+                changed.append(pdf_key)
+                row = {"file": label(pdf_key)}
+                for facet in operations:
+                    if edited_record[facet] != record[facet]:
+                        row[facet] = f"{', '.join(record[facet]) or '-'} → {', '.join(edited_record[facet]) or '-'}"
+                    else:
+                        row[facet] = ""
+                preview.append(row)
+            st.caption(f"{len(changed)} of {len(targets)} file(s) would change.")
+            if preview:
+                st.dataframe(preview, hide_index=True)
+        st.button(
+            f"Update {len(changed)} File(s)",
+            disabled=not changed,
+            on_click=bulk_edit,
+            args=(changed, operations, UPLOAD_WORKERS),
+            key="bulk_edit_apply"
+        )
+
+    # Show the outcome of a rename made just before the page was redrawn
+    if "edit_message" in st.session_state:
+        st.success(st.session_state.pop("edit_message"))
+    if st.session_state.get("edit_pending_selection") in filtered:
+        st.session_state.edit_selection = st.session_state.pop("edit_pending_selection")
+
+    # Warm the metadata cache for the first files in the filtered list
+    prefetch_metadata(filtered[:METADATA_PREFETCH_LIMIT])
+
+    # Browse the filtered files by their first pages; only the thumbnails of
+    # the files shown are read
+    if st.toggle("Browse with previews", key="show_previews"):
+        page_count = max((len(filtered) - 1) // THUMBNAIL_GRID_SIZE + 1, 1)
+        st.session_state.preview_page = min(st.session_state.get("preview_page", 1), page_count)
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, key="preview_page")
+        first = (page - 1) * THUMBNAIL_GRID_SIZE
+        shown = filtered[first:first + THUMBNAIL_GRID_SIZE]
+        thumbnails = get_thumbnails(shown)
+        cols = st.columns(4)
+        for i, pdf_key in enumerate(shown):
+            with cols[i % 4]:
+                if thumbnails[pdf_key]:
+                    st.image(thumbnails[pdf_key], width=THUMBNAIL_WIDTH)
+                else:
+                    st.caption("No preview")
+                st.button(label(pdf_key), key=f"preview_{pdf_key}", on_click=pick_document, args=(pdf_key,))
+
+    # Dropdown to select a file
+    selected_file = st.selectbox(
+        "Select a file to edit",
+        filtered,
+        index=None,
+        format_func=label,
+        key="edit_selection",
+        on_change=reset_edit_form
+    )
+
+    if selected_file:
+        # Fetch metadata CSV file
+        file_name, departments, semesters, tags = "", [], [], []
+        try:
+            # Served from the metadata cache, revalidated by ETag when stale
+            metadata = get_metadata(selected_file)
+            file_name = metadata["file_name"]
+            departments = metadata["departments"]
+            semesters = metadata["semesters"]
+            tags = metadata["tags"]
+        except Exception as e:
+            st.error(f"Error fetching metadata for {selected_file}: {e}")
+
+        # First page of the file, to check that it is the right one
+        try:
+            thumbnail = get_thumbnail(selected_file)
+        except Exception:
+            thumbnail = None
+        if thumbnail:
+            st.image(thumbnail, width=THUMBNAIL_WIDTH)
+
+        # Display file name (editable)
+        current_name = document_name(selected_file, metadata if file_name else None)
+        file_name = file_name or current_name
+        new_name = st.text_input("File Name", value=file_name, key="edit_name")
+
+        # Department selection (multi-select dropdown with "All" option)
+        departments = st.multiselect(
+            "Department(s)",
+            options=["All"] + DEPARTMENTS,
+            default=departments,
+            key="edit_dept"
+        )
+        if "All" in departments:
+            departments = DEPARTMENTS
+
+        # Semester selection (multi-select dropdown with "All" option)
+        semesters = st.multiselect(
+            "Semester(s)",
+            options=["All"] + SEMESTERS,
+            default=semesters,
+            key="edit_sem"
+        )
+        if "All" in semesters:
+            semesters = SEMESTERS
+
+        # Tags selection (multi-select dropdown)
+        tags = st.multiselect(
+            "Tags",
+            options=PREDEFINED_TAGS,
+            default=tags,
+            key="edit_tags"
+        )
+
+        # Save changes button
+        if st.button("Save Changes"):
+            if new_name != current_name:
+                # A new name moves flat documents to new keys
+                try:
+                    before = previous_metadata([selected_file])
+                    record = metadata_record(new_name, departments, semesters, tags)
+                    new_key, record = rename_document(selected_file, new_name, record)
+                    finish_renames([(selected_file, new_key, record)], before)
+                    st.session_state.edit_pending_selection = new_key
+                    st.session_state.edit_message = f"Renamed to {new_name} and updated metadata."
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error renaming file: {e}")
+            else:
+                try:
+                    # Upload updated metadata CSV file to S3
+                    before = previous_metadata([selected_file])[selected_file]
+                    record = metadata_record(new_name, departments, semesters, tags)
+                    put_metadata_csv(selected_file, record)
+                    invalidate_catalog()
+                    apply_metadata_changes({selected_file: record})
+                    log_changes([
+                        change_record(
+                            "update", selected_file, stored_content_hash(selected_file), before, record,
+                            size=document_sizes([selected_file])[selected_file]
+                        )
+                    ])
+                    st.success("Metadata updated successfully!")
+                except Exception as e:
+                    st.error(f"Error updating metadata: {e}")
+
+        # Delete file button
+        if st.button("Delete File"):
+            try:
+                # Delete PDF file and metadata CSV file from S3 in one request
+                before = previous_metadata([selected_file])
+                deleted, errors = delete_documents([selected_file])
+                finish_deletes(deleted, before)
+                if errors:
+                    raise RuntimeError("; ".join(f"{key}: {error}" for key, error in errors))
+                
+                st.success(f"File {label(selected_file)} and its metadata deleted successfully!")
+                # Rerun the script to refresh the file list
+                st.rerun()
+            except Exception as e:
+                st.error(f"Error deleting file: {e}")
+    else:
+        st.warning("No file selected.")
+
+# Streamlit app
+def main():
+    st.title("PDF Upload and Management")
+
+    # Initialize session state for page navigation
+    if "page" not in st.session_state:
+        st.session_state.page = "Home"
+
+    # Sidebar for navigation
+    st.sidebar.title("Admin")
+    if st.sidebar.button("Home"):
+        st.session_state.page = "Home"
+    if st.sidebar.button("Upload Files"):
+        st.session_state.page = "Upload Files"
+    if st.sidebar.button("Edit Existing Files"):
+        st.session_state.page = "Edit Existing Files"
+
+    # Page routing
+    render_start = time.perf_counter()
+    if st.session_state.page == "Home":
+        homepage()
+    elif st.session_state.page == "Upload Files":
+        upload_page()
+    elif st.session_state.page == "Edit Existing Files":
+        edit_page()
+    record_metric("page", st.session_state.page, time.perf_counter() - render_start)
+
+    # Latency metrics for S3 calls and page renders, across all sessions
+    with st.sidebar.expander("Metrics"):
+        summary = metrics_summary()
+        if summary:
+            st.dataframe(summary, hide_index=True)
+        else:
+            st.write("No requests recorded yet.")
+        controller = get_rate_controller()
+        st.caption(
+            f"Bulk S3 concurrency: {controller['in_flight']} in flight, "
+            f"limit {int(controller['limit'])}"
+        )
+        st.download_button(
+            "Download Prometheus Metrics",
+            data=metrics_prometheus(),
+            file_name="ragnroll_metrics.prom",
+            mime="text/plain"
+        )
+
+# Only draw the app when Streamlit runs this file, so that command-line tools
+# such as ingest.py can import the functions above
+if __name__ == "__main__":
+    main()
\ No newline at end of file